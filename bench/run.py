@@ -0,0 +1,423 @@
+"""Офлайн-бенчмарк загрузчика.
+
+Поднимает локальный фейковый медиасервер (синтетические MP4 / HLS / DASH), запускает main.py
+отдельным процессом со стаб-экстрактором yt-dlp (bench/yt_dlp_plugins) и гоняет через него
+/download -> /progress -> /file с заданной параллельностью.
+
+Отчёт: задания в секунду, p50/p95/p99 задержек, CPU и пиковый RSS процесса приложения.
+Результат можно сохранить как baseline и сравнивать с ним следующие прогоны:
+
+    python bench/run.py --jobs 40 --concurrency 8 --save-baseline before
+    python bench/run.py --jobs 40 --concurrency 8 --compare before
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+try:
+    import resource
+except ImportError:  # Windows: CPU/RSS of the app process are not reported
+    resource = None
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+BASELINES_DIR = BENCH_DIR / 'baselines'
+DEFAULT_OUTPUT = REPO_DIR / 'bench_output.txt'
+
+HLS_SEGMENTS = 8
+SEGMENT_SECONDS = 4
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class MediaAssets:
+    """Синтетические медиаданные в памяти: байты не декодируются, важен только объём и протокол"""
+
+    def __init__(self, size_bytes):
+        pattern = bytes(range(256))
+        self.progressive = (pattern * (size_bytes // 256 + 1))[:size_bytes]
+        video_size = size_bytes * 4 // 5
+        self.dash_video = self.progressive[:video_size]
+        self.dash_audio = self.progressive[video_size:]
+        seg = size_bytes // HLS_SEGMENTS
+        self.segment = self.progressive[:seg]
+        self.playlist = '\n'.join(
+            ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}', '#EXT-X-MEDIA-SEQUENCE:0']
+            + [f'#EXTINF:{SEGMENT_SECONDS}.0,\nseg{i}.ts' for i in range(HLS_SEGMENTS)]
+            + ['#EXT-X-ENDLIST', '']).encode()
+
+    def formats(self, base, video_id, kind):
+        media = f'{base}/media/{video_id}'
+        progressive = {
+            'format_id': 'progressive-360', 'url': f'{media}/progressive.mp4', 'ext': 'mp4',
+            'vcodec': 'avc1.4d401e', 'acodec': 'mp4a.40.2', 'width': 640, 'height': 360,
+            'filesize': len(self.progressive),
+        }
+        hls = {
+            'format_id': 'hls-360', 'url': f'{media}/hls/index.m3u8', 'ext': 'mp4', 'protocol': 'm3u8_native',
+            'vcodec': 'avc1.4d401e', 'acodec': 'mp4a.40.2', 'width': 640, 'height': 360,
+        }
+        dash = [
+            {'format_id': 'dash-video-720', 'url': f'{media}/dash/video.mp4', 'ext': 'mp4',
+             'vcodec': 'avc1.64001f', 'acodec': 'none', 'width': 1280, 'height': 720,
+             'filesize': len(self.dash_video)},
+            {'format_id': 'dash-audio', 'url': f'{media}/dash/audio.m4a', 'ext': 'm4a',
+             'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 128, 'filesize': len(self.dash_audio)},
+        ]
+        if kind == 'hls':
+            return [hls]
+        if kind == 'dash':
+            return dash
+        if kind == 'mixed':
+            return [progressive, hls, *dash]
+        return [progressive]
+
+    def body(self, path):
+        if path.endswith('/progressive.mp4'):
+            return self.progressive, 'video/mp4'
+        if path.endswith('/hls/index.m3u8'):
+            return self.playlist, 'application/vnd.apple.mpegurl'
+        if '/hls/seg' in path and path.endswith('.ts'):
+            return self.segment, 'video/mp2t'
+        if path.endswith('/dash/video.mp4'):
+            return self.dash_video, 'video/mp4'
+        if path.endswith('/dash/audio.m4a'):
+            return self.dash_audio, 'audio/mp4'
+        return None, None
+
+
+def make_media_handler(assets, rate, api_latency):
+    class MediaHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.do_GET(head=True)
+
+        def do_GET(self, head=False):
+            parts = urlsplit(self.path)
+            if parts.path.startswith('/api/'):
+                time.sleep(api_latency)
+                video_id = parts.path.rsplit('/', 1)[-1]
+                kind = parse_qs(parts.query).get('kind', ['progressive'])[0]
+                base = f'http://{self.headers.get("Host")}'
+                data = json.dumps({'title': f'bench {video_id}', 'duration': HLS_SEGMENTS * SEGMENT_SECONDS,
+                                   'formats': assets.formats(base, video_id, kind)}).encode()
+                return self._send(200, data, 'application/json', head)
+            body, ctype = assets.body(parts.path)
+            if body is None:
+                return self._send(404, b'not found', 'text/plain', head)
+            start, end = 0, len(body) - 1
+            status = 200
+            rng = self.headers.get('Range')
+            if rng and rng.startswith('bytes='):
+                first, _, last = rng[6:].partition('-')
+                start = int(first) if first else max(0, len(body) - int(last))
+                end = int(last) if first and last else len(body) - 1
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(body)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+            self._send(status, memoryview(body)[start:end + 1], ctype, head,
+                       content_range=f'bytes {start}-{end}/{len(body)}' if status == 206 else None)
+
+        def _send(self, status, data, ctype, head, content_range=None):
+            self.send_response(status)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Accept-Ranges', 'bytes')
+            if content_range:
+                self.send_header('Content-Range', content_range)
+            self.end_headers()
+            if head:
+                return
+            chunk = 64 * 1024
+            try:
+                for offset in range(0, len(data), chunk):
+                    self.wfile.write(data[offset:offset + chunk])
+                    if rate:
+                        time.sleep(chunk / rate)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return MediaHandler
+
+
+def start_media_server(assets, rate, api_latency):
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), make_media_handler(assets, rate, api_latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='bench-media', daemon=True).start()
+    return server
+
+
+def run_app_child(port, workdir):
+    """Режим дочернего процесса: main.py со стаб-экстрактором, без отладчика и перезагрузчика"""
+    sys.path.insert(0, str(BENCH_DIR))  # yt_dlp_plugins namespace with BenchStubIE
+    sys.path.insert(0, str(REPO_DIR))
+    os.chdir(workdir)
+    import logging
+    logging.disable(logging.WARNING)
+    import main
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, main.app, threaded=True)
+    server.serve_forever()
+
+
+def start_app(workdir, env):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), '--app-child', str(port), str(workdir)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'приложение не запустилось: {proc.stderr.read().decode(errors="replace")[-2000:]}')
+        try:
+            requests.get(f'{base}/stats', timeout=1)
+            return proc, base
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('приложение не ответило за 60 секунд')
+
+
+def stop_app(proc):
+    """Останавливает приложение и возвращает (CPU секунды, пиковый RSS в байтах) дочерних процессов"""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    if not resource:
+        return None, None
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    # ru_maxrss: kilobytes on Linux, bytes on macOS
+    rss = after.ru_maxrss if sys.platform == 'darwin' else after.ru_maxrss * 1024
+    return cpu, rss
+
+
+def run_job(session, app_base, media_base, kind, video_id, poll_interval, fetch_file, timeout):
+    """Одна клиентская сессия: /download, опрос /progress до завершения, затем /file"""
+    started = time.monotonic()
+    r = session.post(f'{app_base}/download', json={
+        'url': f'{media_base}/watch/{video_id}?kind={kind}', 'format': 'video', 'quality': 'best'}, timeout=30)
+    data = r.json()
+    if r.status_code != 200 or not data.get('success'):
+        return {'ok': False, 'error': data.get('error') or f'HTTP {r.status_code}'}
+    submitted = time.monotonic()
+    download_id = data['download_id']
+    deadline = started + timeout
+    polls = 0
+    while True:
+        progress = session.get(f'{app_base}/progress/{download_id}', timeout=30).json()
+        polls += 1
+        if progress.get('status') in ('completed', 'error'):
+            break
+        if time.monotonic() > deadline:
+            return {'ok': False, 'error': 'timeout'}
+        time.sleep(poll_interval)
+    completed = time.monotonic()
+    if progress['status'] == 'error':
+        return {'ok': False, 'error': progress.get('error', 'error')}
+    result = {'ok': True, 'submit': submitted - started, 'job': completed - started, 'polls': polls}
+    if fetch_file:
+        file_started = time.monotonic()
+        with session.get(f'{app_base}/file/{progress["filename"]}', stream=True, timeout=60) as fr:
+            size = sum(len(chunk) for chunk in fr.iter_content(256 * 1024))
+        result['file'] = time.monotonic() - file_started
+        result['bytes'] = size
+    return result
+
+
+def summarize(results, wall, cpu, rss, args):
+    ok = [r for r in results if r['ok']]
+    errors = [r['error'] for r in results if not r['ok']]
+
+    def lat(key):
+        values = [r[key] for r in ok if key in r]
+        return {f'p{p}': round(percentile(values, p), 4) if values else None for p in (50, 95, 99)}
+
+    served = sum(r.get('bytes', 0) for r in ok)
+    return {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'jobs': args.jobs, 'concurrency': args.concurrency, 'kind': args.kind,
+                   'size_mb': args.size_mb, 'rate': args.rate, 'repeat': args.repeat},
+        'completed': len(ok),
+        'failed': len(errors),
+        'errors': sorted(set(errors))[:5],
+        'wall_seconds': round(wall, 3),
+        'jobs_per_second': round(len(ok) / wall, 3) if wall else None,
+        'latency_submit': lat('submit'),
+        'latency_job': lat('job'),
+        'latency_file': lat('file'),
+        'served_mb_per_second': round(served / wall / 1024 ** 2, 3) if wall and served else None,
+        'app_cpu_seconds': round(cpu, 3) if cpu is not None else None,
+        'app_peak_rss_mb': round(rss / 1024 ** 2, 1) if rss else None,
+    }
+
+
+# for these a bigger number is better; for the rest (latencies, CPU, RSS) a smaller one
+HIGHER_IS_BETTER = ('jobs_per_second', 'served_mb_per_second')
+
+
+def flatten(report):
+    flat = {}
+    for key in ('jobs_per_second', 'served_mb_per_second', 'app_cpu_seconds', 'app_peak_rss_mb'):
+        flat[key] = report.get(key)
+    for group in ('latency_submit', 'latency_job', 'latency_file'):
+        for pct, value in (report.get(group) or {}).items():
+            flat[f'{group}.{pct}'] = value
+    return flat
+
+
+def compare(report, baseline):
+    lines = [f"{'метрика':<24}{'baseline':>12}{'сейчас':>12}{'изменение':>12}"]
+    current = flatten(report)
+    for key, old in flatten(baseline).items():
+        new = current.get(key)
+        if old is None or new is None:
+            continue
+        delta = (new - old) / old * 100 if old else 0.0
+        better = delta >= 0 if key in HIGHER_IS_BETTER else delta <= 0
+        mark = '' if abs(delta) < 5 else (' +' if better else ' !')
+        lines.append(f'{key:<24}{old:>12g}{new:>12g}{delta:>+11.1f}%{mark}')
+    return '\n'.join(lines)
+
+
+def format_report(report):
+    lines = [
+        f"заданий: {report['completed']} успешно, {report['failed']} с ошибкой за {report['wall_seconds']} с",
+        f"пропускная способность: {report['jobs_per_second']} заданий/с",
+    ]
+    for group, title in (('latency_submit', '/download'), ('latency_job', 'задание целиком'),
+                         ('latency_file', '/file')):
+        values = report[group]
+        if values.get('p50') is not None:
+            lines.append(f"{title}: p50={values['p50']} p95={values['p95']} p99={values['p99']} с")
+    if report['served_mb_per_second']:
+        lines.append(f"отдача /file: {report['served_mb_per_second']} МБ/с")
+    if report['app_cpu_seconds'] is not None:
+        lines.append(f"CPU приложения: {report['app_cpu_seconds']} с, пиковый RSS: {report['app_peak_rss_mb']} МБ")
+    if report['errors']:
+        lines.append('ошибки: ' + '; '.join(e.splitlines()[0][:200] for e in report['errors']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк /download, /progress и /file')
+    parser.add_argument('--jobs', type=int, default=20, help='сколько заданий выполнить')
+    parser.add_argument('--concurrency', type=int, default=4, help='сколько клиентов одновременно')
+    parser.add_argument('--kind', choices=('progressive', 'hls', 'dash', 'mixed'), default='progressive',
+                        help='какие форматы отдаёт стаб-экстрактор (dash требует ffmpeg для слияния)')
+    parser.add_argument('--size-mb', type=float, default=8, help='размер синтетического медиафайла')
+    parser.add_argument('--rate', type=float, default=0, help='ограничение скорости медиасервера, байт/с на соединение')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='задержка ответа метаданных, с')
+    parser.add_argument('--repeat', type=float, default=0.0,
+                        help='доля заданий с уже скачанным id (попадание в каталог)')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--no-file', action='store_true', help='не скачивать готовый файл через /file')
+    parser.add_argument('--timeout', type=float, default=300, help='таймаут одного задания, с')
+    parser.add_argument('--workers', type=int, help='DOWNLOAD_WORKERS приложения')
+    parser.add_argument('--save-baseline', metavar='NAME', help='сохранить результат в bench/baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='сравнить с bench/baselines/NAME.json')
+    parser.add_argument('--output', default=str(DEFAULT_OUTPUT), help='куда записать отчёт')
+    parser.add_argument('--app-child', nargs=2, metavar=('PORT', 'WORKDIR'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.app_child:
+        run_app_child(int(args.app_child[0]), args.app_child[1])
+        return
+
+    assets = MediaAssets(int(args.size_mb * 1024 * 1024))
+    media = start_media_server(assets, args.rate, args.api_latency)
+    media_base = f'http://127.0.0.1:{media.server_address[1]}'
+    workdir = Path(tempfile.mkdtemp(prefix='vdl-bench-'))
+    env = dict(os.environ)
+    if args.workers:
+        env['DOWNLOAD_WORKERS'] = str(args.workers)
+    env.setdefault('DOWNLOAD_QUEUE_SIZE', str(max(100, args.jobs)))
+    env['STORAGE_BUDGET_BYTES'] = '0'
+
+    proc, app_base = start_app(workdir, env)
+    try:
+        # --repeat: part of the jobs reuse ids that were already downloaded (catalog hits)
+        repeated = int(args.jobs * args.repeat)
+        ids = [uuid.uuid4().hex[:12] for _ in range(args.jobs - repeated)]
+        warm = ids[:max(1, min(len(ids), repeated))] if repeated else []
+        ids += [warm[i % len(warm)] for i in range(repeated)] if warm else []
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency * 2)
+        session.mount('http://', adapter)
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            futures = [pool.submit(run_job, session, app_base, media_base, args.kind, video_id,
+                                   args.poll_interval, not args.no_file, args.timeout) for video_id in ids]
+            results = []
+            for f in futures:
+                try:
+                    results.append(f.result())
+                except Exception as e:
+                    results.append({'ok': False, 'error': str(e)})
+        wall = time.monotonic() - started
+    finally:
+        cpu, rss = stop_app(proc)
+        media.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = summarize(results, wall, cpu, rss, args)
+    text = format_report(report)
+    if args.compare:
+        baseline = json.loads((BASELINES_DIR / f'{args.compare}.json').read_text(encoding='utf-8'))
+        text += '\n\nсравнение с baseline ' + args.compare + ':\n' + compare(report, baseline)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + '\n\n' + json.dumps(report, ensure_ascii=False, indent=2) + '\n',
+                                     encoding='utf-8')
+    if args.save_baseline:
+        BASELINES_DIR.mkdir(exist_ok=True)
+        path = BASELINES_DIR / f'{args.save_baseline}.json'
+        path.write_text(json.dumps(report, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
+        print(f'baseline сохранён: {path}')
+
+
+if __name__ == '__main__':
+    main()
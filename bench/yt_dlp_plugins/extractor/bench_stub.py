@@ -0,0 +1,25 @@
+from urllib.parse import parse_qs, urlsplit
+
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BenchStubIE(InfoExtractor):
+    """Экстрактор для бенчмарка: метаданные и форматы берёт с локального фейкового медиасервера (bench/run.py)"""
+
+    IE_NAME = 'benchstub'
+    _VALID_URL = r'https?://(?:127\.0\.0\.1|localhost):\d+/watch/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        parts = urlsplit(url)
+        kind = parse_qs(parts.query).get('kind', ['progressive'])[0]
+        meta = self._download_json(
+            f'{parts.scheme}://{parts.netloc}/api/{video_id}', video_id, query={'kind': kind})
+        return {
+            'id': video_id,
+            'title': meta['title'],
+            'duration': meta.get('duration'),
+            'uploader': 'bench',
+            'webpage_url': url,
+            'formats': meta['formats'],
+        }
@@ -1,4 +1,4 @@
-from flask import Flask, render_template_string, request, jsonify, send_file, session
+from flask import Flask, render_template_string, request, jsonify, session, Response, redirect
 import yt_dlp
 import os
 import datetime
@@ -12,6 +12,17 @@ import json
 import shutil
 import requests
 import mimetypes
+import collections
+import copy
+import sqlite3
+import sys
+import contextlib
+import atexit
+import unicodedata
+import subprocess
+import glob
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+from werkzeug.http import is_resource_modified
 
 # Helper: try to locate ffmpeg in common places and project folder
 def find_ffmpeg():
@@ -33,6 +44,108 @@ def find_ffmpeg():
 
     return None
 
+
+class FFmpegCapabilities:
+    """Что умеет найденный ffmpeg: версия, кодировщики, мультиплексоры, аппаратное ускорение"""
+
+    PROBE_TIMEOUT = 15
+
+    def __init__(self, path=None):
+        self.path = path
+        self.ffprobe_path = None
+        self.version = None
+        self.encoders = frozenset()
+        self.muxers = frozenset()
+        self.hwaccels = ()
+        self.probed_at = None
+        self.probe_seconds = None
+        self.error = None
+
+    @classmethod
+    def probe(cls, path):
+        caps = cls(path)
+        if not path:
+            return caps
+        started = time.monotonic()
+        try:
+            caps.version = caps._run('-version').splitlines()[0].strip()
+            caps.encoders = frozenset(caps._parse_table(caps._run('-encoders')))
+            caps.muxers = frozenset(caps._parse_table(caps._run('-muxers')))
+            caps.hwaccels = tuple(line.strip() for line in caps._run('-hwaccels').splitlines()[1:] if line.strip())
+        except Exception as e:
+            caps.error = str(e)
+            logger.warning(f"Не удалось опросить ffmpeg ({path}): {e}")
+        ffprobe = Path(path).with_name(Path(path).name.replace('ffmpeg', 'ffprobe'))
+        caps.ffprobe_path = str(ffprobe) if ffprobe.exists() else shutil.which('ffprobe')
+        caps.probed_at = time.time()
+        caps.probe_seconds = round(time.monotonic() - started, 3)
+        return caps
+
+    def _run(self, flag):
+        out = subprocess.run([self.path, '-hide_banner', flag], capture_output=True, text=True,
+                             timeout=self.PROBE_TIMEOUT)
+        return out.stdout
+
+    @staticmethod
+    def _parse_table(text):
+        # rows look like " V....D libx264  description" / " E mp4   MP4 (MPEG-4 Part 14)" after a "--" separator
+        names = []
+        body = text.split(' --', 1)[-1] if ' --' in text else text
+        for line in body.splitlines():
+            parts = line.split()
+            if len(parts) >= 2 and not parts[0].startswith('='):
+                names.extend(parts[1].split(','))
+        return names
+
+    @property
+    def available(self):
+        return bool(self.path) and self.error is None
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def has_muxer(self, name):
+        return name in self.muxers
+
+    @property
+    def can_merge_mp4(self):
+        # without a successful probe trust the binary, as before the probe existed
+        return bool(self.path) and (self.error is not None or self.has_muxer('mp4'))
+
+    def to_dict(self):
+        interesting = ('libx264', 'libx265', 'h264_nvenc', 'h264_qsv', 'h264_videotoolbox', 'aac',
+                       'libmp3lame', 'libopus', 'libvorbis', 'mjpeg')
+        return {
+            'path': self.path,
+            'ffprobe_path': self.ffprobe_path,
+            'available': self.available,
+            'version': self.version,
+            'encoders_total': len(self.encoders),
+            'encoders': {name: name in self.encoders for name in interesting},
+            'muxers_total': len(self.muxers),
+            'muxers': {name: name in self.muxers for name in ('mp4', 'ipod', 'matroska', 'webm', 'mp3', 'mpegts')},
+            'hwaccels': list(self.hwaccels),
+            'probed_at': self.probed_at,
+            'probe_seconds': self.probe_seconds,
+            'error': self.error,
+        }
+
+
+_ffmpeg_caps = None
+_ffmpeg_caps_lock = threading.Lock()
+
+def get_ffmpeg_caps(refresh=False):
+    """ffmpeg ищется и опрашивается один раз за процесс (при старте), дальше берётся готовый результат"""
+    global _ffmpeg_caps
+    with _ffmpeg_caps_lock:
+        if _ffmpeg_caps is None or refresh:
+            _ffmpeg_caps = FFmpegCapabilities.probe(find_ffmpeg())
+            if _ffmpeg_caps.path:
+                logger.info(f"Using ffmpeg at: {_ffmpeg_caps.path} ({_ffmpeg_caps.version})")
+            else:
+                logger.info("ffmpeg not found in PATH or local folder; merging formats may fail.")
+        return _ffmpeg_caps
+
 # Инициализация Flask приложения
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-' + str(uuid.uuid4())
@@ -40,20 +153,586 @@ app.secret_key = 'your-secret-key-' + str(uuid.uuid4())
 # Настройка путей
 DOWNLOADS_DIR = Path('downloads')
 DOWNLOADS_DIR.mkdir(exist_ok=True)
-LOG_FILE = DOWNLOADS_DIR / 'log.txt'
+# Журнал событий загрузок: JSON по строке на событие, пишется фоновым потоком
+LOG_FILE = DOWNLOADS_DIR / 'log.jsonl'
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = 5
+# Сколько событий писать за раз, как часто сбрасывать на диск и сколько держать в очереди
+# (при переполнении старые события отбрасываются, загрузки никогда не ждут диск)
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 1.0
+LOG_QUEUE_SIZE = 10000
+# Каталог скачанных файлов (SQLite) — заменяет .json файлы рядом с медиа
+CATALOG_DB = DOWNLOADS_DIR / 'catalog.sqlite3'
+# Журнал выполняющихся загрузок (SQLite): после падения/перезапуска они продолжаются
+JOBS_DB = DOWNLOADS_DIR / 'jobs.sqlite3'
 
 # Toggle: when True, if a file already exists we treat it as "already downloaded" and skip.
 # When False, existing files will be removed and the downloader will re-download (useful for forcing fresh files).
 CHECK_DOWNLOADED = True
 
+# Докачка: загрузки пишутся в .part файлы и продолжаются по HTTP Range после обрыва сети или
+# перезапуска процесса (прерванные задания поднимаются из журнала с тем же download_id)
+RESUMABLE_DOWNLOADS = True
+
+# Пул загрузок: сколько yt-dlp задач выполняется одновременно и сколько может ждать в очереди.
+# Лишние запросы к /download получают отказ вместо запуска ещё одного потока.
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '4'))
+DOWNLOAD_QUEUE_SIZE = int(os.environ.get('DOWNLOAD_QUEUE_SIZE', '100'))
+
+# Постобработка (ffmpeg merge/remux/convert/extract) идёт в отдельном пуле по числу ядер, чтобы
+# перекодирование не забирало потоки загрузок и процессор у веб-воркеров. POSTPROCESS_NICE — nice
+# для ffmpeg (0 — не менять), POSTPROCESS_CPUS — список ядер вида '2-5,7' (пусто — все).
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS', str(os.cpu_count() or 2)))
+POSTPROCESS_QUEUE_SIZE = int(os.environ.get('POSTPROCESS_QUEUE_SIZE', '200'))
+POSTPROCESS_NICE = int(os.environ.get('POSTPROCESS_NICE', '10'))
+POSTPROCESS_CPUS = os.environ.get('POSTPROCESS_CPUS', '')
+
+# SSE-поток прогресса: как часто слать комментарий-пинг, если ничего не менялось,
+# и через сколько миллисекунд браузер должен переподключиться после обрыва
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 3000
+
+# Частота публикации прогресса из progress_hook: не чаще раза в PROGRESS_MIN_INTERVAL секунд,
+# и только если процент сдвинулся на PROGRESS_MIN_DELTA (скорость/ETA обновляются раз в PROGRESS_MAX_INTERVAL)
+PROGRESS_MIN_INTERVAL = 0.25
+PROGRESS_MIN_DELTA = 0.5
+PROGRESS_MAX_INTERVAL = 1.0
+
+# Отдача файла во время загрузки (/stream/<download_id>): для одиночных форматов клиент читает
+# файл по мере записи, а раздельные видео+аудио ffmpeg сразу склеивает во фрагментированный MP4
+STREAMING_ENABLED = True
+# fMP4: moov в начале и фрагменты по ключевым кадрам — браузер может начать воспроизведение сразу
+FRAGMENTED_MP4_FLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+# Аудио: 'passthrough' — отдаём исходную дорожку (AAC в m4a, Opus, MP3) без перекодирования,
+# копируя поток в подходящий контейнер; 'mp3' — всегда перекодировать в MP3 (как раньше).
+# Клиент может запросить MP3 явно ({"audio_format": "mp3"}) при любой политике.
+AUDIO_OUTPUT_POLICY = os.environ.get('AUDIO_OUTPUT_POLICY', 'passthrough').lower()
+AUDIO_MP3_BITRATE = '192'
+# Контейнеры, которые браузеры играют как есть — для них ffmpeg вообще не запускается
+AUDIO_DIRECT_EXTS = ('m4a', 'mp3')
+
+# Аудио и картинка для ролика, видео которого уже скачано, извлекаются из этого файла (без сети).
+# Источник — видео в контейнерах, из которых аудио копируется без перекодирования.
+DERIVE_SOURCE_EXTS = ('.mp4', '.mov', '.webm')
+
+# Видео в другом качестве из кэша: 'exact' — только точное совпадение; 'serve-higher' — отдать уже
+# скачанный файл ближайшего более высокого качества; 'downscale' — локально уменьшить его ffmpeg
+# до запрошенного (если не вышло — отдаётся более высокое). Качество файла видно в поле variant.
+VIDEO_CACHE_POLICY = os.environ.get('VIDEO_CACHE_POLICY', 'serve-higher').lower()
+
+# Отдача файлов: имена детерминированы (id + формат + качество), поэтому браузер может кэшировать их надолго
+FILE_CACHE_MAX_AGE = 365 * 24 * 3600
+FILE_CHUNK_SIZE = 256 * 1024
+# Больше диапазонов в одном Range-запросе не обслуживаем (отдаём файл целиком)
+MAX_RANGES_PER_REQUEST = 16
+# WSGI-серверы, чей wsgi.file_wrapper начинает с текущей позиции файла и ограничивается Content-Length,
+# так что диапазон тоже уходит через sendfile()
+RANGE_FILE_WRAPPER_SERVERS = ('gunicorn', 'waitress')
+
+# Отдача файлов фронтовым прокси: Flask только проверяет файл и возвращает заголовок,
+# а байты отправляет сам прокси.
+#   ''           — файл отдаёт Flask
+#   'x-accel'    — nginx (X-Accel-Redirect на internal location X_ACCEL_PREFIX, смотрящий в DOWNLOADS_DIR)
+#   'x-sendfile' — Apache mod_xsendfile / lighttpd (X-Sendfile с абсолютным путём)
+FILE_OFFLOAD = os.environ.get('FILE_OFFLOAD', '').lower()
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-downloads/')
+
+# Квота на папку загрузок: при превышении верхней отметки удаляются давно не отдававшиеся файлы,
+# пока занятое место не опустится до нижней. 0 — без ограничения по объёму.
+STORAGE_BUDGET_BYTES = int(os.environ.get('STORAGE_BUDGET_BYTES', str(20 * 1024 ** 3)))
+STORAGE_HIGH_WATERMARK = 0.90
+STORAGE_LOW_WATERMARK = 0.75
+# Сколько свободного места оставлять на томе независимо от квоты
+STORAGE_MIN_FREE_BYTES = int(os.environ.get('STORAGE_MIN_FREE_BYTES', str(1024 ** 3)))
+# Файлы, которые недавно отдавались или ещё пишутся (свежий mtime), не удаляются
+STORAGE_GRACE_SECONDS = 600
+# last_access в каталоге обновляется не чаще, чем раз в столько секунд на файл
+STORAGE_TOUCH_INTERVAL = 60
+# Занятое место считается по каталогу и текущим загрузкам; полный обход папки (файлы вне каталога,
+# брошенные .part) — не чаще раза в столько секунд
+STORAGE_SCAN_INTERVAL = 300
+
+# Состояние заданий в памяти: завершённые задания забываются через JOB_STATE_TTL секунд,
+# а всего записей не больше JOB_STATE_MAX_ENTRIES (самые старые вытесняются)
+JOB_STATE_TTL = int(os.environ.get('JOB_STATE_TTL', '3600'))
+JOB_STATE_MAX_ENTRIES = int(os.environ.get('JOB_STATE_MAX_ENTRIES', '10000'))
+
+# Кэш метаданных yt-dlp (extract_info): максимум записей и время жизни по сайтам в секундах.
+# Ссылки на потоки в метаданных со временем протухают, поэтому TTL у разных сайтов разный.
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', '512'))
+# Общий лимит кэша в байтах (по размеру сериализованных метаданных): у длинных видео
+# списки форматов с фрагментами весят мегабайты
+METADATA_CACHE_BYTES = int(os.environ.get('METADATA_CACHE_BYTES', str(64 * 1024 * 1024)))
+METADATA_CACHE_TTL = {
+    'youtube': 1800,     # googlevideo URLs live ~6h, keep a wide safety margin
+    'tiktok': 600,
+    'instagram': 600,
+    'pinterest': 3600,
+    'other': 900,
+}
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Хранилище прогресса загрузок
-download_progress = {}
+
+class EventLog:
+    """Фоновый писатель журнала: события копятся в очереди и пишутся пачками JSON-строк с ротацией по размеру"""
+
+    FIELDS = ('ts', 'event', 'job_id', 'phase', 'user', 'url', 'file', 'format', 'quality', 'method',
+              'bytes', 'durations', 'message')
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUP_COUNT, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, max_queue=LOG_QUEUE_SIZE):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = collections.deque(maxlen=max_queue)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._writing = False
+        self.written = 0
+        self.dropped = 0
+
+    def emit(self, event, **fields):
+        """Ставит событие в очередь; не блокирует вызывающий поток"""
+        record = {name: fields.get(name) for name in self.FIELDS}
+        record['ts'] = datetime.datetime.now().isoformat(timespec='milliseconds')
+        record['event'] = event
+        with self._cond:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1  # deque drops the oldest entry
+            self._pending.append(record)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-log', daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                self._writing = bool(batch)
+            if batch:
+                self._write(batch)
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        data = ''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in batch)
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+                size = f.tell()
+            self.written += len(batch)
+            if self.max_bytes and size >= self.max_bytes:
+                self._rotate()
+        except Exception as e:
+            logger.error(f"Ошибка записи в лог: {e}")
+
+    def _rotate(self):
+        # log.jsonl -> log.jsonl.1 -> ... -> log.jsonl.<backups>
+        for i in range(self.backups - 1, 0, -1):
+            src = self.path.with_name(f'{self.path.name}.{i}')
+            if src.exists():
+                os.replace(src, self.path.with_name(f'{self.path.name}.{i + 1}'))
+        if self.backups:
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.1'))
+        else:
+            self.path.unlink()
+
+    def flush(self, timeout=5.0):
+        """Ждёт, пока очередь будет записана (при остановке процесса)"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify()
+            while (self._pending or self._writing) and self._thread is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.1))
+                self._cond.notify()
+        return True
+
+    def stats(self):
+        return {'queued': len(self._pending), 'written': self.written, 'dropped': self.dropped}
+
+
+event_log = EventLog(LOG_FILE)
+atexit.register(event_log.flush)
+
+
+class Metric:
+    """Метрика в формате Prometheus: значения по наборам меток"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def _fmt_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (n + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                   for n, v in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, self._fmt_labels(key), value) for key, value in items]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {value:g}' for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Значение вычисляется при каждом опросе функцией collect() -> {метки: значение}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), collect=None):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect() if self.collect else {}
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, self._fmt_labels(key if isinstance(key, tuple) else (key,)), value)
+                for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(st[0]), st[1], st[2])) for key, st in self._values.items()]
+        out = []
+        for key, (counts, total, count) in items:
+            for bound, c in zip(self.buckets, counts):
+                out.append((f'{self.name}_bucket', self._fmt_labels(key, [('le', f'{bound:g}')]), c))
+            out.append((f'{self.name}_bucket', self._fmt_labels(key, [('le', '+Inf')]), count))
+            out.append((f'{self.name}_sum', self._fmt_labels(key), total))
+            out.append((f'{self.name}_count', self._fmt_labels(key), count))
+        return out
+
+
+class MetricsRegistry:
+    """Набор метрик, отдаваемый на /metrics в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self._metrics) + '\n'
+
+
+metrics = MetricsRegistry()
+METRIC_JOBS_FINISHED = metrics.register(Counter(
+    'downloader_jobs_finished_total', 'Finished download jobs by outcome', ('site', 'status')))
+METRIC_DOWNLOADED_BYTES = metrics.register(Counter(
+    'downloader_downloaded_bytes_total', 'Bytes fetched from media sites', ('site',)))
+METRIC_SERVED_BYTES = metrics.register(Counter(
+    'downloader_served_bytes_total', 'Bytes of media sent by /file (offloaded responses are counted by the front server)'))
+METRIC_SERVED_REQUESTS = metrics.register(Counter(
+    'downloader_served_requests_total', 'Requests to /file by HTTP status', ('code',)))
+METRIC_FILE_CACHE = metrics.register(Counter(
+    'downloader_file_cache_requests_total', 'Jobs answered from an existing file (hit), derived from a cached video (derived) or downloaded (miss)', ('result',)))
+METRIC_FALLBACKS = metrics.register(Counter(
+    'downloader_fallback_total', 'Use of fallback download paths', ('path', 'result')))
+METRIC_OUTPUT_PATH = metrics.register(Counter(
+    'downloader_output_path_total',
+    'Jobs by postprocessing path: direct/none (no ffmpeg), merge/remux (stream copy), convert/transcode (re-encode), frame (still from a cached video)',
+    ('format', 'path')))
+METRIC_EXTRACT_SECONDS = metrics.register(Histogram(
+    'downloader_extract_seconds', 'Metadata extraction time (extract_info, including cache hits)', ('site',)))
+METRIC_DOWNLOAD_SECONDS = metrics.register(Histogram(
+    'downloader_download_seconds', 'Media transfer time', ('site',)))
+METRIC_POSTPROCESS_SECONDS = metrics.register(Histogram(
+    'downloader_postprocess_seconds', 'Postprocessing time (ffmpeg merge/convert) after the transfer', ('site', 'path')))
+
+class JobProgress:
+    """Изменяемая запись о состоянии загрузки; обновляется на месте, без создания новых dict"""
+
+    __slots__ = ('status', 'progress', 'filename', 'format', 'error',
+                 'speed', 'eta', 'downloaded_bytes', 'total_bytes', 'stream_url', 'timings', 'variant',
+                 'published_at')
+
+    FIELDS = ('progress', 'status', 'filename', 'format', 'error',
+              'speed', 'eta', 'downloaded_bytes', 'total_bytes', 'stream_url', 'timings', 'variant')
+
+    def __init__(self, data=None):
+        self.reset(data or {})
+
+    def reset(self, data):
+        """Заменяет состояние целиком (поля, которых нет в data, очищаются)"""
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+        if self.progress is None:
+            self.progress = 0
+        self.published_at = time.monotonic()
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.FIELDS else None
+        return default if value is None else value
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+
+class PhaseTimer:
+    """Длительности фаз задания по монотонным часам: очередь, извлечение, передача, постобработка, поиск файла"""
+
+    __slots__ = ('started', 'durations')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.durations = {}
+
+    def record(self, phase, seconds):
+        self.durations[phase] = self.durations.get(phase, 0) + max(0.0, seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def get(self, phase):
+        return self.durations.get(phase)
+
+    def as_dict(self):
+        data = {phase: round(seconds, 3) for phase, seconds in self.durations.items()}
+        data['total'] = round(time.monotonic() - self.started, 3)
+        return data
+
+
+class JobStore:
+    """Хранилище прогресса загрузок: download_id -> JobProgress, с TTL для завершённых и лимитом записей.
+
+    Завершённые задания стоят в отдельной очереди по последнему обновлению, поэтому истёкшие и лишние
+    снимаются с её начала за O(1); выполняющиеся в эту очередь не попадают и не вытесняются.
+    """
+
+    FINISHED = ('completed', 'error')
+
+    def __init__(self, max_entries, ttl, on_drop=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_drop = on_drop
+        self._items = {}  # download_id -> [JobProgress, время обновления]
+        self._finished = collections.OrderedDict()  # завершённые download_id, старые в начале
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, download_id):
+        return download_id in self._items
+
+    def __getitem__(self, download_id):
+        return self._items[download_id][0]
+
+    def get(self, download_id, default=None):
+        item = self._items.get(download_id)
+        return default if item is None else item[0]
+
+    def records(self):
+        with self._lock:
+            return [item[0] for item in self._items.values()]
+
+    def __setitem__(self, download_id, record):
+        with self._lock:
+            self._items[download_id] = [record, time.monotonic()]
+            self._track_locked(download_id, record)
+            dropped = self._trim_locked()
+        self._dropped(dropped)
+
+    def touch(self, download_id):
+        """Отмечает обновление записи (TTL завершённого задания считается от последнего обновления)"""
+        with self._lock:
+            item = self._items.get(download_id)
+            if item is None:
+                return
+            item[1] = time.monotonic()
+            self._track_locked(download_id, item[0])
+            dropped = self._trim_locked()
+        self._dropped(dropped)
+
+    def pop(self, download_id, default=None):
+        with self._lock:
+            item = self._items.pop(download_id, None)
+            self._finished.pop(download_id, None)
+        if item is None:
+            return default
+        self._dropped([download_id])
+        return item[0]
+
+    def _track_locked(self, download_id, record):
+        # a job joins the expiry order when it finishes and leaves it if it is restarted
+        if record.status in self.FINISHED:
+            self._finished[download_id] = None
+            self._finished.move_to_end(download_id)
+        else:
+            self._finished.pop(download_id, None)
+
+    def _trim_locked(self):
+        dropped = []
+        now = time.monotonic()
+        while self._finished:
+            download_id = next(iter(self._finished))
+            if now - self._items[download_id][1] >= self.ttl:
+                self.expired += 1
+            elif len(self._items) > self.max_entries:
+                self.evicted += 1
+            else:
+                break
+            del self._finished[download_id]
+            del self._items[download_id]
+            dropped.append(download_id)
+        return dropped
+
+    def _dropped(self, dropped):
+        # outside of our lock: on_drop takes inflight_lock, which is held while reading the store
+        if dropped and self.on_drop:
+            for download_id in dropped:
+                self.on_drop(download_id)
+
+    def expire(self):
+        with self._lock:
+            dropped = self._trim_locked()
+        self._dropped(dropped)
+        return len(dropped)
+
+    def footprint(self):
+        """Приблизительный объём памяти записей (байты, по sys.getsizeof)"""
+        with self._lock:
+            items = list(self._items.items())
+        total = sys.getsizeof(self._items)
+        for download_id, item in items:
+            record = item[0]
+            total += sys.getsizeof(download_id) + sys.getsizeof(item) + sys.getsizeof(record)
+            total += sum(sys.getsizeof(getattr(record, f)) for f in JobProgress.FIELDS
+                         if getattr(record, f) is not None)
+        return total
+
+    def stats(self):
+        self.expire()
+        with inflight_lock:
+            side = (sys.getsizeof(download_cancelled) + sys.getsizeof(progress_versions)
+                    + sys.getsizeof(download_aliases) + sys.getsizeof(download_followers))
+            side_entries = len(download_cancelled) + len(progress_versions) + len(download_aliases)
+        return {
+            'entries': len(self._items),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'memory_bytes': self.footprint(),
+            'side_table_entries': side_entries,
+            'side_table_bytes': side,
+        }
+
+
+def forget_job(download_id):
+    """Убирает всё, что связано с забытым заданием: флаги отмены, версии SSE, подписчиков"""
+    with inflight_lock:
+        ids = [download_id, *download_followers.pop(download_id, ())]
+        for job_id in ids:
+            download_aliases.pop(job_id, None)
+            download_cancelled.pop(job_id, None)
+    with progress_lock:
+        for job_id in ids:
+            progress_versions.pop(job_id, None)
+
+
+# Хранилище прогресса загрузок: download_id -> JobProgress
+download_progress = JobStore(JOB_STATE_MAX_ENTRIES, JOB_STATE_TTL, on_drop=forget_job)
 # Флаги отмены загрузок
 download_cancelled = {}
+# Уведомления об изменении прогресса для SSE: download_id -> номер версии
+progress_versions = {}
+# download_id -> [Condition, число ждущих]; будятся только подписчики этого задания
+progress_waiters = {}
+progress_lock = threading.Lock()
+
+# Single-flight: одинаковые запросы (ссылка, формат, качество), пришедшие пока загрузка идёт,
+# не запускают её повторно, а подписываются на уже выполняющееся задание.
+# ключ задания -> download_id ведущей (реально выполняющейся) загрузки
+inflight_jobs = {}
+# download_id ведущей загрузки -> её ключ
+inflight_keys = {}
+# download_id подписчика -> download_id ведущей загрузки, чей прогресс он разделяет
+download_aliases = {}
+# download_id ведущей загрузки -> множество download_id подписчиков
+download_followers = {}
+inflight_lock = threading.Lock()
+
+# Потоковая отдача: download_id -> ожидаемый путь файла (если клиент запросил stream)
+stream_candidates = {}
+# download_id -> файл, который сейчас пишется и может читаться через /stream/<download_id>
+streaming_files = {}
+
+# Для метрик: download_id -> {файл: байт уже учтено}, сайт задания и момент окончания передачи (перед постобработкой)
+transfer_seen = {}
+transfer_sites = {}
+transfer_finished_at = {}
 
 # Простая мапа код->полное русское название + флаг (дополняйте по необходимости)
 LANG_LABELS = {
@@ -651,8 +1330,25 @@ HTML_TEMPLATE = '''
                 <option value="480">480p — Среднее 📼</option>
                 <option value="360">360p — Плохое 📱</option>
             </select>
+            <div style="margin-top:10px; display:flex; align-items:center; gap:8px;">
+                <input type="checkbox" id="watchWhileDownloading" class="hidden-toggle" />
+                <label for="watchWhileDownloading" class="pretty-toggle">
+                    <span class="toggle-track">
+                        <span class="toggle-thumb">✓</span>
+                    </span>
+                    <span class="toggle-label">▶️ Смотреть во время загрузки (без докачки)</span>
+                </label>
+            </div>
         </div>
         
+        <div class="quality-selector" id="audioFormatSelector" style="display:none;">
+            <label for="audioFormat">🎧 Формат аудио:</label>
+            <select id="audioFormat">
+                <option value="original" selected>Оригинал (m4a / opus) — быстро, без потерь ⚡</option>
+                <option value="mp3">MP3 — для старых плееров 💿</option>
+            </select>
+        </div>
+
         <button class="download-btn" onclick="startDownload()">
             ⬇️ Скачать
         </button>
@@ -676,6 +1372,8 @@ HTML_TEMPLATE = '''
         let selectedFormat = 'video';
         let downloadId = null;
         let progressInterval = null;
+        let progressSource = null;
+        let streamShown = false;
         
         function selectFormat(format) {
             // If photo is requested, show a 'В разработке' popup instead of selecting
@@ -691,6 +1389,7 @@ HTML_TEMPLATE = '''
             document.querySelector(`[data-format="${format}"]`).classList.add('active');
             
             const qualitySelector = document.getElementById('qualitySelector');
+            document.getElementById('audioFormatSelector').style.display = (format === 'audio') ? 'block' : 'none';
             const urlInput = document.getElementById('url');
             if (format === 'video') {
                 qualitySelector.style.display = 'block';
@@ -711,6 +1410,7 @@ HTML_TEMPLATE = '''
                 return;
             }
             const quality = document.getElementById('quality').value;
+            const audioFormat = document.getElementById('audioFormat').value;
             
             const downloadBtn = document.querySelector('.download-btn');
             
@@ -722,16 +1422,21 @@ HTML_TEMPLATE = '''
             document.getElementById('progressFill').textContent = '0%';
             document.getElementById('mediaPlayer').style.display = 'none';
             document.getElementById('statusMessage').style.display = 'none';
+            streamShown = false;
             
             try {
                 // audio track selection removed: let yt-dlp pick defaults
                 const checkDownloaded = document.getElementById('checkDownloaded') ? document.getElementById('checkDownloaded').checked : true;
+                // streaming is opt-in: a streamed job is written without .part files and can't resume
+                const watchWhileDownloading = selectedFormat === 'video' && document.getElementById('watchWhileDownloading').checked;
 
                 // persist choices so reload doesn't lose them
                 try {
                     localStorage.setItem('dv_url', url);
                     localStorage.setItem('dv_format', selectedFormat);
                     localStorage.setItem('dv_quality', quality);
+                    localStorage.setItem('dv_audio_format', audioFormat);
+                    localStorage.setItem('dv_stream', watchWhileDownloading ? 'true' : 'false');
                 } catch (e) { console.warn('localStorage not available', e); }
 
                 const response = await fetch('/download', {
@@ -739,7 +1444,7 @@ HTML_TEMPLATE = '''
                     headers: {
                         'Content-Type': 'application/json',
                     },
-                    body: JSON.stringify({ url: url, format: selectedFormat, quality: quality, check_downloaded: checkDownloaded })
+                    body: JSON.stringify({ url: url, format: selectedFormat, quality: quality, audio_format: audioFormat, check_downloaded: checkDownloaded, stream: watchWhileDownloading })
                 });
                 
                 const data = await response.json();
@@ -763,41 +1468,113 @@ HTML_TEMPLATE = '''
         }
         
         function startProgressTracking() {
+            stopProgressTracking();
+            // Prefer the SSE stream; polling is only a fallback
+            if (window.EventSource) {
+                startProgressStream();
+            } else {
+                startProgressPolling();
+            }
+        }
+
+        function stopProgressTracking() {
+            if (progressSource) {
+                progressSource.close();
+                progressSource = null;
+            }
+            if (progressInterval) {
+                clearInterval(progressInterval);
+                progressInterval = null;
+            }
+        }
+
+        function startProgressStream() {
+            let received = false;
+            const source = new EventSource(`/progress/${downloadId}/stream`);
+            progressSource = source;
+            source.onmessage = (event) => {
+                received = true;
+                try {
+                    handleProgress(JSON.parse(event.data));
+                } catch (error) {
+                    console.error('Ошибка получения прогресса:', error);
+                }
+            };
+            source.onerror = () => {
+                // EventSource reconnects on its own after a drop; give up on it only if
+                // the stream never worked or the browser closed it for good
+                if (progressSource !== source) return;
+                if (!received || source.readyState === EventSource.CLOSED) {
+                    stopProgressTracking();
+                    startProgressPolling();
+                }
+            };
+        }
+
+        function startProgressPolling() {
             progressInterval = setInterval(async () => {
                 try {
                     const response = await fetch(`/progress/${downloadId}`);
                     const data = await response.json();
-                    
-                    if (data.progress !== undefined) {
-                        const progress = Math.round(data.progress);
-                        document.getElementById('progressFill').style.width = progress + '%';
-                        document.getElementById('progressFill').textContent = progress + '%';
-                        
-                        if (data.status === 'completed') {
-                            clearInterval(progressInterval);
-                            document.getElementById('cancelBtn').style.display = 'none';
-                            showStatus('✅ Скачивание завершено!', 'success');
-                            displayMedia(data.filename, data.format);
-                            
-                            const downloadBtn = document.querySelector('.download-btn');
-                            downloadBtn.disabled = false;
-                            downloadBtn.innerHTML = '⬇️ Скачать';
-                        } else if (data.status === 'error') {
-                            clearInterval(progressInterval);
-                            document.getElementById('cancelBtn').style.display = 'none';
-                            showStatus('❌ ' + (data.error || 'Ошибка при скачивании'), 'error');
-                            
-                            const downloadBtn = document.querySelector('.download-btn');
-                            downloadBtn.disabled = false;
-                            downloadBtn.innerHTML = '⬇️ Скачать';
-                            document.getElementById('progressContainer').style.display = 'none';
-                        }
-                    }
+                    handleProgress(data);
                 } catch (error) {
                     console.error('Ошибка получения прогресса:', error);
                 }
             }, 500);
         }
+
+        function handleProgress(data) {
+            if (data.status === 'queued') {
+                document.getElementById('progressFill').style.width = '0%';
+                document.getElementById('progressFill').textContent = data.position ? `В очереди: ${data.position}` : 'В очереди';
+                return;
+            }
+            if (data.status === 'postprocessing') {
+                document.getElementById('progressFill').style.width = '100%';
+                document.getElementById('progressFill').textContent = data.position ? `Обработка, в очереди: ${data.position}` : 'Обработка...';
+                return;
+            }
+            // Start playback from the growing file as soon as the server offers a stream
+            if (data.stream_url && !streamShown && data.status !== 'completed') {
+                streamShown = true;
+                displayStream(data.stream_url);
+            }
+            if (data.progress !== undefined) {
+                const progress = Math.round(data.progress);
+                document.getElementById('progressFill').style.width = progress + '%';
+                document.getElementById('progressFill').textContent = progress + '%';
+                
+                if (data.status === 'completed') {
+                    stopProgressTracking();
+                    document.getElementById('cancelBtn').style.display = 'none';
+                    const requestedQuality = document.getElementById('quality').value;
+                    if (data.format === 'video' && data.variant && data.variant !== requestedQuality) {
+                        showStatus(`✅ Готово: уже было скачано в ${data.variant}p`, 'success');
+                    } else {
+                        showStatus('✅ Скачивание завершено!', 'success');
+                    }
+                    if (streamShown) {
+                        // keep the running player, just offer the finished file
+                        addSaveButton(data.filename);
+                    } else {
+                        displayMedia(data.filename, data.format);
+                    }
+                    
+                    const downloadBtn = document.querySelector('.download-btn');
+                    downloadBtn.disabled = false;
+                    downloadBtn.innerHTML = '⬇️ Скачать';
+                } else if (data.status === 'error') {
+                    stopProgressTracking();
+                    document.getElementById('cancelBtn').style.display = 'none';
+                    showStatus('❌ ' + (data.error || 'Ошибка при скачивании'), 'error');
+                    
+                    const downloadBtn = document.querySelector('.download-btn');
+                    downloadBtn.disabled = false;
+                    downloadBtn.innerHTML = '⬇️ Скачать';
+                    document.getElementById('progressContainer').style.display = 'none';
+                }
+            }
+        }
         
             async function cancelDownload() {
                 if (!downloadId) return;
@@ -829,7 +1606,8 @@ HTML_TEMPLATE = '''
                 `;
             } else if (format === 'audio') {
                 const ext = filename.split('.').pop().toLowerCase();
-                const atype = (ext === 'mp3') ? 'audio/mpeg' : (ext === 'm4a' ? 'audio/mp4' : 'audio/mpeg');
+                const atypes = { mp3: 'audio/mpeg', m4a: 'audio/mp4', mp4: 'audio/mp4', opus: 'audio/ogg', ogg: 'audio/ogg', webm: 'audio/webm' };
+                const atype = atypes[ext] || 'audio/mpeg';
                 mediaHtml = `
                     <audio controls autoplay>
                         <source src="/file/${filename}" type="${atype}">
@@ -862,6 +1640,35 @@ HTML_TEMPLATE = '''
             }
         }
         
+        function displayStream(streamUrl) {
+            const mediaPlayer = document.getElementById('mediaPlayer');
+            mediaPlayer.style.display = 'block';
+            mediaPlayer.classList.remove('is-vertical');
+            mediaPlayer.innerHTML = `
+                <div class="media-player-container">
+                    <video controls autoplay>
+                        <source src="${streamUrl}" type="video/mp4">
+                        Ваш браузер не поддерживает видео.
+                    </video>
+                </div>
+            `;
+            const video = mediaPlayer.querySelector('video');
+            video.onloadedmetadata = () => {
+                if (video.videoHeight > video.videoWidth) {
+                    mediaPlayer.classList.add('is-vertical');
+                }
+            };
+        }
+
+        function addSaveButton(filename) {
+            const mediaPlayer = document.getElementById('mediaPlayer');
+            const btn = document.createElement('button');
+            btn.className = 'download-file-btn';
+            btn.textContent = '💾 Сохранить на устройство';
+            btn.onclick = () => downloadFile(filename);
+            mediaPlayer.appendChild(btn);
+        }
+
         function downloadFile(filename) {
             window.location.href = `/file/${filename}?download=true`;
         }
@@ -932,6 +1739,9 @@ HTML_TEMPLATE = '''
             if (savedUrl) document.getElementById('url').value = savedUrl;
             if (savedFormat && savedFormat !== 'photo') selectFormat(savedFormat);
             if (savedQuality) document.getElementById('quality').value = savedQuality;
+            const savedAudioFormat = localStorage.getItem('dv_audio_format');
+            if (savedAudioFormat) document.getElementById('audioFormat').value = savedAudioFormat;
+            if (localStorage.getItem('dv_stream') === 'true') document.getElementById('watchWhileDownloading').checked = true;
             if (savedCheck !== null && document.getElementById('checkDownloaded')) document.getElementById('checkDownloaded').checked = (savedCheck === 'true');
         } catch (e) { /* ignore */ }
 
@@ -963,149 +1773,1663 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-def log_download(user_ip, url, filename, status):
-    """Записывает информацию о загрузке в лог-файл"""
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    log_entry = f"[{timestamp}] Пользователь: {user_ip} | Ссылка: {url} | Файл: {filename} | Статус: {status}\n"
-    
-    try:
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(log_entry)
-            f.flush()
-    except Exception as e:
-        logger.error(f"Ошибка записи в лог: {e}")
+# Query parameters that never change which media a URL points to
+TRACKING_PARAMS = {'si', 'feature', 'pp', 't', 'start', 'fbclid', 'gclid', 'igshid', 'igsh',
+                   'is_from_webapp', 'sender_device', 'share_app_id', 'ab_channel'}
 
-def progress_hook(d, download_id):
-    """Обработчик прогресса загрузки"""
-    # If user requested cancel, raise to abort yt-dlp
-    if download_cancelled.get(download_id):
-        raise Exception('Загрузка отменена пользователем')
-    if d['status'] == 'downloading':
-        try:
-            # Извлекаем прогресс из строки или числа
-            if 'downloaded_bytes' in d and 'total_bytes' in d:
-                progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
-            elif 'downloaded_bytes' in d and 'total_bytes_estimate' in d:
-                progress = (d['downloaded_bytes'] / d['total_bytes_estimate']) * 100
-            elif '_percent_str' in d:
-                percent_str = d['_percent_str'].strip().replace('%', '')
-                progress = float(percent_str)
-            else:
-                progress = 0
-            download_progress[download_id] = {
-                'progress': progress,
-                'status': 'downloading'
-            }
-        except Exception as e:
-            logger.error(f"Ошибка обработки прогресса: {e}")
-    
-    elif d['status'] == 'finished':
-        download_progress[download_id]['progress'] = 100
-        download_progress[download_id]['status'] = 'processing'
+# Домены Pinterest (как в экстракторе yt-dlp): pinterest.<tld>
+PINTEREST_TLDS = ('com', 'fr', 'de', 'ch', 'jp', 'cl', 'ca', 'it', 'co.uk', 'nz', 'ru', 'com.au', 'at', 'pt',
+                  'co.kr', 'es', 'com.mx', 'dk', 'ph', 'th', 'com.uy', 'co', 'nl', 'info', 'kr', 'ie', 'vn',
+                  'com.vn', 'ec', 'mx', 'in', 'pe', 'co.at', 'hu', 'co.in', 'co.nz', 'id', 'com.ec', 'com.py',
+                  'tw', 'be', 'uk', 'com.bo', 'com.pe')
 
-def download_media(url, format_type, quality, download_id, user_ip, check_downloaded=None):
-    """Функция загрузки медиа в отдельном потоке"""
-    try:
-        # Получим метаданные (id/title) через extract_info, без загрузки
-        ydl_info_opts = {'quiet': True, 'no_warnings': True}
-        with yt_dlp.YoutubeDL(ydl_info_opts) as ydl_info:
-            info = ydl_info.extract_info(url, download=False)
+def host_matches(host, *domains):
+    """host — один из доменов или их поддомен (notyoutube.com не считается youtube.com)"""
+    return any(host == d or host.endswith('.' + d) for d in domains)
 
-        if not info:
-            raise Exception("Не удалось получить информацию о видео. Проверьте ссылку.")
+def site_of_url(url):
+    """Короткое имя сайта по ссылке: youtube / tiktok / pinterest / instagram / other"""
+    host = (urlsplit(url.strip()).hostname or '').lower()
+    if host_matches(host, 'youtu.be', 'youtube.com', 'youtube-nocookie.com'):
+        return 'youtube'
+    if host_matches(host, 'tiktok.com'):
+        return 'tiktok'
+    if host_matches(host, 'pin.it', *(f'pinterest.{tld}' for tld in PINTEREST_TLDS)):
+        return 'pinterest'
+    if host_matches(host, 'instagram.com'):
+        return 'instagram'
+    return 'other'
 
-        video_id = info.get('id') or str(uuid.uuid4())
-        title = re.sub(r"[^0-9A-Za-zА-Яа-я_\- ]+", '', info.get('title') or 'media')
-        title_short = title.strip().replace(' ', '_')[:60]
+def normalize_url(url):
+    """Нормализует ссылку для использования в качестве ключа кэша"""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if parts.port:
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith('utm_')
+    )
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit(((parts.scheme or 'https').lower(), host, path, urlencode(query), ''))
 
-        # Deterministic filename using video id, format and quality
-        if format_type == 'audio':
-            ext = 'mp3'
-            filename = f"audio_{video_id}_{title_short}.{ext}"
-        elif format_type == 'photo':
-            # photos we'll save as JPGs
-            ext = 'jpg'
-            filename = f"photo_{video_id}_{title_short}.{ext}"
-        else:
-            ext = 'mp4'
-            filename = f"video_{video_id}_{title_short}_{quality}.{ext}"
+# Офлайн-канонизация ссылок: (сайт, id) определяется по строке ссылки без сетевых запросов.
+# Id совпадают с теми, что возвращает yt-dlp, поэтому по ним можно искать в каталоге.
+YOUTUBE_ID_RE = re.compile(r'^[0-9A-Za-z_-]{11}$')
+CANONICAL_URL_TEMPLATES = {
+    'youtube': 'https://www.youtube.com/watch?v={id}',
+    'tiktok': 'https://www.tiktok.com/embed/{id}',
+    'pinterest': 'https://www.pinterest.com/pin/{id}/',
+    'instagram': 'https://www.instagram.com/p/{id}/',
+}
 
-        filepath = DOWNLOADS_DIR / filename
+def canonicalize_url(url):
+    """(сайт, id) для ссылок YouTube/TikTok/Pinterest/Instagram, либо None если id не виден в ссылке"""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    segments = [seg for seg in parts.path.split('/') if seg]
+    site = site_of_url(url)
 
-    # If file already exists, skip download and mark completed
-        meta_file = filepath.with_suffix(filepath.suffix + '.json')
-        # determine whether to honor existing files for this download (per-request overrides global)
-        effective_check = CHECK_DOWNLOADED if check_downloaded is None else bool(check_downloaded)
+    if site == 'youtube':
+        video_id = None
+        if host == 'youtu.be':
+            video_id = segments[0] if segments else None
+        elif segments and segments[0] == 'watch':
+            video_id = dict(parse_qsl(parts.query)).get('v')
+        elif len(segments) >= 2 and segments[0] in ('shorts', 'embed', 'live', 'v', 'e'):
+            video_id = segments[1]
+        if video_id and YOUTUBE_ID_RE.match(video_id):
+            return ('youtube', video_id)
 
-        if filepath.exists():
-            if effective_check:
-                # Populate progress as completed and include metadata if available
-                download_progress[download_id] = {
-                    'progress': 100,
-                    'status': 'completed',
-                    'filename': filepath.name,
-                    'format': format_type
-                }
-                # Log detailed info
-                log_entry = (
-                    f"[{datetime.datetime.now().isoformat()}] SKIP: file exists | user: {user_ip} | url: {url} | "
-                    f"file: {filepath.name} | size: {filepath.stat().st_size}"
-                )
-                try:
-                    with open(LOG_FILE, 'a', encoding='utf-8') as lf:
-                        lf.write(log_entry + '\n')
-                except Exception:
-                    pass
-                return
-            else:
-                # When CHECK_DOWNLOADED is False, remove existing file and proceed to redownload
-                try:
-                    existing_size = filepath.stat().st_size
-                    filepath.unlink()
-                    # Also try to remove metadata file if exists
-                    try:
-                        if meta_file.exists():
-                            meta_file.unlink()
-                    except Exception:
-                        pass
-                    with open(LOG_FILE, 'a', encoding='utf-8') as lf:
-                        lf.write(f"[{datetime.datetime.now().isoformat()}] REDOWNLOAD: removed existing file ({existing_size} bytes) | user: {user_ip} | url: {url} | file: {filepath.name}\n")
-                except Exception as e:
-                    # If we couldn't remove, still try to continue but log
-                    try:
-                        with open(LOG_FILE, 'a', encoding='utf-8') as lf:
-                            lf.write(f"[{datetime.datetime.now().isoformat()}] WARNING: failed to remove existing file: {e} | file: {filepath.name}\n")
-                    except Exception:
-                        pass
+    elif site == 'tiktok':
+        # /@user/video/<id>, /@user/photo/<id>, /embed/v2/<id>, m.tiktok.com/v/<id>.html
+        # (vm./vt. short links need a redirect and can't be resolved offline)
+        for i, seg in enumerate(segments[:-1]):
+            if seg in ('video', 'photo', 'v2', 'v', 'embed'):
+                candidate = segments[i + 1].split('.')[0]
+                if candidate.isdigit():
+                    return ('tiktok', candidate)
 
-        # Handle photo format: try to download thumbnail or image URL from info
-        if format_type == 'photo':
-            # info may contain thumbnails
-            thumbnail_url = None
-            if 'thumbnail' in info and info['thumbnail']:
-                thumbnail_url = info['thumbnail']
-            else:
-                # try thumbnails list
-                thumbs = info.get('thumbnails') or info.get('thumbnails')
-                if thumbs and isinstance(thumbs, list) and len(thumbs) > 0:
-                    thumbnail_url = thumbs[-1].get('url')
+    elif site == 'pinterest':
+        # /pin/<id>/ or /pin/<slug>--<id>/ (pin.it short links need a redirect)
+        if len(segments) >= 2 and segments[0] == 'pin':
+            candidate = segments[1].rsplit('--', 1)[-1]
+            if candidate.isdigit():
+                return ('pinterest', candidate)
 
-            # If no thumbnail found via yt-dlp metadata, attempt site-specific scrape for Pinterest images
-            def try_pinterest_image_download(page_url, out_path):
-                try:
-                    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
-                    r = requests.get(page_url, headers=headers, timeout=15)
-                    r.raise_for_status()
-                    html = r.text
-                    # Try og:image
-                    m = re.search(r'<meta[^>]+property=["\']og:image["\'][^>]+content=["\']([^"\']+)["\']', html, re.I)
-                    if not m:
-                        # Look for JSON LD or initial state with images
-                        m = re.search(r'"images":\s*\[\s*\{[^\}]*"url":"([^"]+)"', html)
-                    if not m:
-                        # fallback to first <img src=...> in the pin content area
-                        m = re.search(r'<img[^>]+src=["\']([^"\']+)["\'][^>]*class=["\'][^"\']*pinImage[^"\']*["\']', html, re.I)
-                    if not m:
+    elif site == 'instagram':
+        # /p/<code>, /reel/<code>, /reels/<code>, /tv/<code>, optionally after /<user>/
+        for i, seg in enumerate(segments[:-1]):
+            if seg in ('p', 'reel', 'reels', 'tv'):
+                return ('instagram', segments[i + 1])
+
+    return None
+
+def canonical_url(url):
+    """Каноническая ссылка для известных сайтов, иначе нормализованная"""
+    canon = canonicalize_url(url)
+    if canon:
+        return CANONICAL_URL_TEMPLATES[canon[0]].format(id=canon[1])
+    return normalize_url(url)
+
+
+class MetadataCache:
+    """LRU-кэш результатов extract_info с TTL по сайтам и лимитом по записям и байтам"""
+
+    # поля, которые загрузке не нужны, а весят больше всего остального
+    DROP_KEYS = ('subtitles', 'automatic_captions', 'requested_subtitles', 'heatmap')
+
+    def __init__(self, max_entries, ttls, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self._entries = collections.OrderedDict()  # key -> (expires_at, serialized info)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, blob = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                self._bytes -= len(blob)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # a fresh copy every time: callers are free to mutate what they get back
+        return json.loads(blob)
+
+    @classmethod
+    def _serialize(cls, info):
+        trimmed = {k: v for k, v in info.items() if k not in cls.DROP_KEYS}
+        thumbs = trimmed.get('thumbnails')
+        if isinstance(thumbs, list) and thumbs:
+            # для фото берётся только последнее (лучшее) превью
+            trimmed['thumbnails'] = thumbs[-1:]
+        return json.dumps(yt_dlp.YoutubeDL.sanitize_info(trimmed), ensure_ascii=False).encode('utf-8')
+
+    def put(self, key, info, site='other'):
+        ttl = self.ttls.get(site, self.ttls.get('other', 0))
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        blob = self._serialize(info)
+        if self.max_bytes and len(blob) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (time.monotonic() + ttl, blob)
+            self._bytes += len(blob)
+            while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                _, (_, evicted_blob) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted_blob)
+                self.evicted += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL, METADATA_CACHE_BYTES)
+
+def extract_info_cached(url):
+    """extract_info без загрузки, с кэшированием по канонической ссылке"""
+    key = canonical_url(url)
+    info = metadata_cache.get(key)
+    if info is not None:
+        return info
+    ydl_info_opts = {'quiet': True, 'no_warnings': True}
+    with yt_dlp.YoutubeDL(ydl_info_opts) as ydl_info:
+        info = ydl_info.extract_info(url, download=False)
+    if info:
+        metadata_cache.put(key, info, site_of_url(url))
+    return info
+
+class DownloadCatalog:
+    """Каталог скачанных файлов в SQLite с индексами по имени файла и по (сайт, id, формат, качество)"""
+
+    COLUMNS = ('filename', 'site', 'media_id', 'url', 'format', 'quality', 'title', 'uploader',
+               'method', 'size', 'created_at', 'last_access', 'timings', 'postprocess')
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    filename TEXT PRIMARY KEY,
+                    site TEXT,
+                    media_id TEXT,
+                    url TEXT,
+                    format TEXT,
+                    quality TEXT,
+                    title TEXT,
+                    uploader TEXT,
+                    method TEXT,
+                    size INTEGER,
+                    created_at REAL,
+                    last_access REAL,
+                    timings TEXT,
+                    postprocess TEXT
+                )''')
+            # columns added after the first catalog version: per-phase timings, output path taken
+            columns = {row['name'] for row in self._conn.execute('PRAGMA table_info(files)')}
+            for column in ('timings', 'postprocess'):
+                if column not in columns:
+                    self._conn.execute(f'ALTER TABLE files ADD COLUMN {column} TEXT')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_media ON files(site, media_id, format, quality)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_url ON files(url, format, quality)')
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0:
+            # First start with a catalog: import what older versions left on disk
+            imported = self.rebuild_from_sidecars()
+            with self._lock, self._conn:
+                self._conn.execute('PRAGMA user_version=1')
+            if imported:
+                logger.info(f"Каталог загрузок восстановлен из .json файлов: {imported} записей")
+            version = 1
+        if version == 1:
+            # older versions always converted audio to MP3; '' is now the passthrough (_orig) variant
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "UPDATE files SET quality = 'mp3' WHERE format = 'audio' AND quality = '' "
+                    "AND filename LIKE '%.mp3' AND filename NOT LIKE '%\\_orig.mp3' ESCAPE '\\'")
+                self._conn.execute('PRAGMA user_version=2')
+
+    def get(self, filename):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM files WHERE filename = ?', (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def find(self, site, media_id, format_type, quality=''):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM files WHERE site = ? AND media_id = ? AND format = ? AND quality = ? '
+                'ORDER BY created_at DESC LIMIT 1',
+                (site, media_id, format_type, quality or '')).fetchone()
+        return dict(row) if row else None
+
+    def find_largest(self, site, media_id, format_type):
+        """Файлы формата для этого id, начиная с самого высокого качества"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM files WHERE site = ? AND media_id = ? AND format = ? '
+                'ORDER BY CAST(quality AS INTEGER) DESC, size DESC',
+                (site, media_id, format_type)).fetchall()
+        return [dict(row) for row in rows]
+
+    def add(self, filename, **fields):
+        now = time.time()
+        row = {c: fields.get(c) for c in self.COLUMNS}
+        row['filename'] = filename
+        row['quality'] = row['quality'] or ''
+        row['created_at'] = row['created_at'] or now
+        row['last_access'] = row['last_access'] or row['created_at']
+        placeholders = ', '.join('?' for _ in self.COLUMNS)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO files ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+                tuple(row[c] for c in self.COLUMNS))
+
+    def remove(self, filename):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM files WHERE filename = ?', (filename,))
+
+    def set_timings(self, filename, timings):
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE files SET timings = ? WHERE filename = ?', (json.dumps(timings), filename))
+
+    def touch(self, filename, when=None):
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE files SET last_access = ? WHERE filename = ?', (when or time.time(), filename))
+
+    def total_size(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+
+    def filenames(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute('SELECT filename FROM files')}
+
+    def least_recently_used(self, accessed_before):
+        """Файлы в порядке давности последней отдачи"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT filename, size, last_access FROM files WHERE last_access < ? ORDER BY last_access',
+                (accessed_before,)).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _sidecar_media(meta_path):
+        # the sidecar was named after the planned file (video_x_720.mp4.json), while yt-dlp
+        # may have saved another container (video_x_720.webm)
+        media_path = meta_path.with_suffix('')
+        if media_path.is_file():
+            return media_path
+        for candidate in sorted(media_path.parent.glob(glob.escape(media_path.stem) + '.*')):
+            if candidate.suffix not in ('.json', '.part', '.ytdl') and candidate.is_file():
+                return candidate
+        return None
+
+    @staticmethod
+    def _legacy_quality(format_type, media_path, meta):
+        if format_type == 'video':
+            return str(meta.get('quality_requested') or '')
+        if format_type == 'audio' and media_path.suffix == '.mp3' and not media_path.stem.endswith('_orig'):
+            # до режима passthrough аудио всегда конвертировалось в MP3
+            return 'mp3'
+        return ''
+
+    def rebuild_from_sidecars(self):
+        """Импортирует файлы, скачанные старыми версиями (метаданные из .json рядом с файлом)"""
+        count = 0
+        for meta_path in DOWNLOADS_DIR.glob('*.json'):
+            media_path = self._sidecar_media(meta_path)
+            if media_path is None:
+                continue
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as mf:
+                    meta = json.load(mf)
+            except Exception as e:
+                logger.warning(f"Пропущен повреждённый файл метаданных {meta_path.name}: {e}")
+                continue
+            prefix = media_path.name.split('_', 1)[0]
+            format_type = meta.get('format') or (prefix if prefix in ('video', 'audio', 'photo') else 'video')
+            source_url = meta.get('url') or ''
+            downloaded_at = meta.get('downloaded_at')
+            try:
+                created_at = datetime.datetime.fromisoformat(downloaded_at).timestamp() if downloaded_at else None
+            except ValueError:
+                created_at = None
+            self.add(
+                media_path.name,
+                site=site_of_url(source_url) if source_url else None,
+                media_id=meta.get('id'),
+                url=canonical_url(source_url) if source_url else None,
+                format=format_type,
+                quality=self._legacy_quality(format_type, media_path, meta),
+                title=meta.get('title'),
+                uploader=meta.get('uploader'),
+                method=meta.get('method'),
+                size=media_path.stat().st_size,
+                created_at=created_at or media_path.stat().st_mtime,
+            )
+            count += 1
+        return count
+
+
+catalog = DownloadCatalog(CATALOG_DB)
+
+
+class StorageManager:
+    """Держит папку загрузок в пределах квоты, вытесняя давно не отдававшиеся файлы (LRU по каталогу)"""
+
+    def __init__(self, root, budget, high=STORAGE_HIGH_WATERMARK, low=STORAGE_LOW_WATERMARK,
+                 min_free=STORAGE_MIN_FREE_BYTES):
+        self.root = Path(root)
+        self.budget = budget
+        self.high = high
+        self.low = low
+        self.min_free = min_free
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._served = {}
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.runs = 0
+        self.last_run = None
+        self.last_usage = None
+        self._scanned_at = 0
+        self._untracked = 0
+        self._stale_parts = []  # (mtime, filename, size) брошенных .part, старые первыми
+
+    def mark_served(self, filename):
+        """Файл только что отдавался (каждый Range-запрос плеера обновляет отметку)"""
+        with self._lock:
+            self._served[filename] = time.time()
+
+    def is_busy(self, filename):
+        # A response that is already sending keeps its open file even after unlink on POSIX, and on
+        # Windows unlink of an open file fails; the grace window protects the player's next Range request.
+        with self._lock:
+            served = self._served.get(filename)
+            if served is not None and time.time() - served >= STORAGE_GRACE_SECONDS:
+                del self._served[filename]
+                served = None
+        return served is not None
+
+    def usage(self):
+        """Занятое место: файлы каталога, байты текущих загрузок и то, что нашёл последний обход папки"""
+        if time.time() - self._scanned_at >= STORAGE_SCAN_INTERVAL:
+            self.scan()
+        inflight = sum(sum(parts.values()) for parts in list(transfer_seen.values()))
+        total = catalog.total_size() + inflight + self._untracked
+        self.last_usage = total
+        return total
+
+    def scan(self):
+        """Обход папки: байты файлов вне каталога и брошенные .part (отменённые и не докачанные задания)"""
+        known = catalog.filenames()
+        now = time.time()
+        untracked = 0
+        stale_parts = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                try:
+                    if entry.name in known or not entry.is_file(follow_symlinks=False):
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if entry.name.endswith('.part'):
+                    if now - st.st_mtime < STORAGE_GRACE_SECONDS:
+                        continue  # being written: counted through the running job
+                    stale_parts.append((st.st_mtime, entry.name, st.st_size))
+                untracked += st.st_size
+        stale_parts.sort()
+        with self._lock:
+            self._untracked = untracked
+            self._stale_parts = stale_parts
+            self._scanned_at = now
+
+    def _bytes_to_free(self, usage, evicting):
+        # evicting: go down to the low mark (hysteresis), otherwise only check the high mark
+        need = 0
+        if self.budget:
+            need = usage - int(self.budget * (self.low if evicting else self.high))
+        if self.min_free:
+            try:
+                free = shutil.disk_usage(self.root).free
+            except OSError:
+                free = None
+            if free is not None:
+                target = self.min_free
+                if evicting and self.budget:
+                    target += int(self.budget * (self.high - self.low))
+                need = max(need, target - free)
+        return need
+
+    def maybe_evict(self):
+        """Вытесняет файлы, если превышена верхняя отметка; возвращает число удалённых файлов"""
+        if not self._evict_lock.acquire(blocking=False):
+            return 0  # another worker is already evicting
+        try:
+            usage = self.usage()
+            if self._bytes_to_free(usage, False) <= 0:
+                return 0
+            need = self._bytes_to_free(usage, True)
+            self.runs += 1
+            self.last_run = time.time()
+            now = time.time()
+            freed = removed = 0
+            # leftovers of cancelled or abandoned jobs go before any finished file
+            with self._lock:
+                stale_parts = list(self._stale_parts)
+            deleted = set()
+            for _, name, _ in stale_parts:
+                if freed >= need:
+                    break
+                path = self.root / name
+                try:
+                    st = path.stat()
+                    if now - st.st_mtime < STORAGE_GRACE_SECONDS:
+                        continue  # a resumed job is writing it again
+                    path.unlink()
+                except OSError:
+                    continue
+                deleted.add(name)
+                freed += st.st_size
+                removed += 1
+            with self._lock:
+                self._stale_parts = [part for part in self._stale_parts if part[1] not in deleted]
+                self._untracked = max(0, self._untracked - freed)
+            for entry in catalog.least_recently_used(now - STORAGE_GRACE_SECONDS):
+                if freed >= need:
+                    break
+                name = entry['filename']
+                path = self.root / name
+                if self.is_busy(name) or path in streaming_files.values():
+                    continue
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    catalog.remove(name)
+                    continue
+                if now - st.st_mtime < STORAGE_GRACE_SECONDS:
+                    continue  # still being written or just replaced
+                try:
+                    path.unlink()
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить {name} при очистке места: {e}")
+                    continue
+                catalog.remove(name)
+                # sidecar left by older versions
+                path.with_name(name + '.json').unlink(missing_ok=True)
+                freed += st.st_size
+                removed += 1
+            self.evictions += removed
+            self.evicted_bytes += freed
+            self.last_usage = usage - freed
+            if removed:
+                logger.info(f"Очистка места: удалено файлов {removed}, освобождено {freed} байт")
+            if freed < need:
+                logger.warning(f"Очистка места: не хватило {need - freed} байт, все оставшиеся файлы заняты")
+            return removed
+        finally:
+            self._evict_lock.release()
+
+    def stats(self):
+        return {
+            'budget_bytes': self.budget,
+            'high_watermark': self.high,
+            'low_watermark': self.low,
+            'min_free_bytes': self.min_free,
+            'usage_bytes': self.last_usage,
+            'untracked_bytes': self._untracked,
+            'stale_part_files': len(self._stale_parts),
+            'last_scan': self._scanned_at or None,
+            'recently_served': len(self._served),
+            'eviction_runs': self.runs,
+            'evicted_files': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+            'last_run': self.last_run,
+        }
+
+
+storage = StorageManager(DOWNLOADS_DIR, STORAGE_BUDGET_BYTES)
+
+
+class JobJournal:
+    """Журнал заданий в SQLite (только дописывается): подача, смены состояния и результаты.
+
+    По нему после перезапуска восстанавливаются завершённые задания и продолжаются незавершённые.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS job_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    download_id TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    data TEXT,
+                    at REAL NOT NULL
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS job_events_id ON job_events(download_id)')
+            self._migrate_running_table()
+
+    def _migrate_running_table(self):
+        # the earlier journal only kept a row per running job
+        if not self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'job_journal'").fetchone():
+            return
+        for row in self._conn.execute('SELECT * FROM job_journal').fetchall():
+            params = {
+                'url': row['url'], 'format': row['format'], 'quality': row['quality'], 'user_ip': row['user_ip'],
+                'check_downloaded': None if row['check_downloaded'] is None else bool(row['check_downloaded']),
+                'stream': bool(row['stream']),
+            }
+            self._conn.execute('INSERT INTO job_events (download_id, event, data, at) VALUES (?, ?, ?, ?)',
+                               (row['download_id'], 'submitted', json.dumps(params), row['created_at']))
+            self._conn.execute('INSERT INTO job_events (download_id, event, data, at) VALUES (?, ?, ?, ?)',
+                               (row['download_id'], 'running', None, row['updated_at']))
+        self._conn.execute('DROP TABLE job_journal')
+
+    def record(self, download_id, event, data=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO job_events (download_id, event, data, at) VALUES (?, ?, ?, ?)',
+                (download_id, event, None if data is None else json.dumps(data, ensure_ascii=False), time.time()))
+
+    def replay(self):
+        """Сворачивает журнал в последнее известное состояние каждого задания"""
+        with self._lock:
+            rows = self._conn.execute('SELECT download_id, event, data, at FROM job_events ORDER BY seq').fetchall()
+        jobs = {}
+        for row in rows:
+            job = jobs.setdefault(row['download_id'], {
+                'params': None, 'state': None, 'result': None, 'leader': None,
+                'cancelled': False, 'attempts': 0, 'updated_at': row['at'],
+            })
+            data = json.loads(row['data']) if row['data'] else None
+            event = row['event']
+            job['updated_at'] = row['at']
+            if event == 'submitted':
+                job['params'] = data
+                job['state'] = 'queued'
+            elif event == 'attached':
+                job['leader'] = data['leader']
+                job['state'] = 'attached'
+            elif event == 'running':
+                job['state'] = 'running'
+                job['attempts'] += 1
+            elif event == 'cancelled':
+                job['cancelled'] = True
+            elif event in ('completed', 'error'):
+                job['state'] = event
+                job['result'] = data
+        return jobs
+
+    def compact(self, older_than):
+        """Удаляет события заданий, последнее событие которых старше older_than"""
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                'DELETE FROM job_events WHERE download_id IN ('
+                'SELECT download_id FROM job_events GROUP BY download_id HAVING MAX(at) < ?)', (older_than,))
+            return cur.rowcount
+
+
+job_journal = JobJournal(JOBS_DB)
+# Сколько раз пробовать продолжить одно и то же прерванное задание (защита от заданий, роняющих процесс)
+MAX_RESUME_ATTEMPTS = 3
+# Сколько хранить в журнале задания без новых событий
+JOB_JOURNAL_RETENTION = 24 * 3600
+# Состояния, которые записываются в журнал вместе с результатом
+JOURNALED_STATES = ('completed', 'error')
+
+def find_downloaded_file(result, filepath):
+    """Итоговый файл по результату yt-dlp — без перебора всего каталога загрузок"""
+    for requested in (result or {}).get('requested_downloads') or []:
+        candidate = requested.get('filepath')
+        if candidate and Path(candidate).is_file():
+            return Path(candidate)
+    if filepath.is_file():
+        return filepath
+    # yt-dlp may have picked another container than the one in the deterministic name
+    for ext in ('mp4', 'mkv', 'webm', 'mov', 'm4a', 'mp3', 'opus', 'ogg', 'jpg', 'png', 'webp'):
+        candidate = filepath.with_suffix('.' + ext)
+        if candidate.is_file():
+            return candidate
+    return None
+
+def download_with_info(ydl, info, url):
+    """Скачивает по уже извлечённым метаданным, не вызывая extract_info повторно"""
+    # Same path yt-dlp uses for --load-info-json: drop selection results of the first pass
+    # so format selection runs again with this instance's options.
+    prepared = ydl.sanitize_info(copy.deepcopy(info), remove_private_keys=True)
+    try:
+        return ydl.process_ie_result(prepared, download=True)
+    except (yt_dlp.utils.DownloadError, yt_dlp.utils.ReExtractInfo) as e:
+        # Stream URLs from (cached) metadata may have expired: extract again once
+        if isinstance(e, yt_dlp.utils.ReExtractInfo) or 'http error 403' in str(e).lower():
+            logger.warning('Сохранённые метаданные устарели, повторное извлечение')
+            METRIC_FALLBACKS.inc(path='reextract', result='used')
+            metadata_cache.invalidate(canonical_url(url))
+            return ydl.extract_info(url, download=True)
+        raise
+
+class PooledYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL, который запускает постобработку в postprocess_pool, а не в потоке загрузки"""
+
+    # postprocessors that produce a new file; a converter that skips (mp4 -> mp4) leaves filepath as is
+    TRACKED_PPS = ('Merger', 'VideoConvertor', 'VideoRemuxer', 'ExtractAudio')
+
+    def __init__(self, params=None, download_id=None, **kwargs):
+        super().__init__(params, **kwargs)
+        self.download_id = download_id
+        self.postprocess_wait = 0.0
+        self.postprocessors_ran = []
+
+    def run_pp(self, pp, infodict):
+        before = infodict.get('filepath')
+        infodict = super().run_pp(pp, infodict)
+        key = pp.pp_key()
+        if key in self.TRACKED_PPS and (key == 'Merger' or infodict.get('filepath') != before):
+            self.postprocessors_ran.append(key)
+        return infodict
+
+    def post_process(self, filename, info, files_to_move=None):
+        run = super().post_process
+        if self.download_id is None or not (info.get('__postprocessors') or self._pps['post_process']):
+            # nothing for ffmpeg to do, only moving files into place
+            return run(filename, info, files_to_move)
+        # yt-dlp only postprocesses after the transfer has finished, so the download slot can go
+        result, wait = run_postprocess(self.download_id, run, filename, info, files_to_move, release_slot=True)
+        self.postprocess_wait += wait
+        return result
+
+def run_postprocess(download_id, func, *args, release_slot=False):
+    """Выполняет CPU-работу задания в postprocess_pool и ждёт результата.
+
+    release_slot=True отдаёт место в download_pool следующему заданию — только когда после этой
+    работы задание уже не ходит в сеть (запасной путь с загрузкой должен оставаться в пределах пула).
+    Возвращает (результат, время ожидания в очереди).
+    """
+    done = threading.Event()
+    outcome = {'wait': 0.0}
+    queued_at = time.monotonic()
+
+    def task():
+        outcome['wait'] = time.monotonic() - queued_at
+        try:
+            if is_job_cancelled(download_id):
+                raise Exception('Загрузка отменена пользователем')
+            set_job_status(download_id, 'postprocessing')
+            outcome['result'] = func(*args)
+        except BaseException as e:
+            outcome['error'] = e
+        finally:
+            done.set()
+
+    if not postprocess_pool.submit(download_id, task):
+        logger.warning(f"Очередь постобработки заполнена, {download_id} обрабатывается в потоке загрузки")
+        task()
+    else:
+        set_job_status(download_id, 'postprocessing')
+        if release_slot:
+            # the transfer is over: let the next download start while this job waits for a CPU slot
+            download_pool.release_slot()
+        while not done.wait(1.0):
+            if is_job_cancelled(download_id) and postprocess_pool.discard(download_id):
+                raise Exception('Загрузка отменена пользователем')
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result'], outcome['wait']
+
+def set_job_status(download_id, status):
+    record = download_progress.get(download_id)
+    if record is not None and record.status != status:
+        record.status = status
+        notify_progress(download_id)
+
+def select_formats(ydl_opts, info):
+    """Форматы, которые yt-dlp выберет с этими опциями — без загрузки и без сети"""
+    opts = {k: v for k, v in ydl_opts.items() if k not in ('progress_hooks', 'postprocessors')}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        selected = ydl.process_ie_result(ydl.sanitize_info(copy.deepcopy(info), remove_private_keys=True), download=False)
+    if not selected:
+        return []
+    return selected.get('requested_formats') or [selected]
+
+def merge_fragmented_mp4(download_id, formats, out_path, duration, ffmpeg_path, ydl_opts=None):
+    """Качает и склеивает видео+аудио одним ffmpeg в фрагментированный MP4, который можно читать во время записи"""
+    cmd = [ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y']
+    ydl_opts = ydl_opts or {}
+    # Same inputs yt-dlp's own ffmpeg downloader passes: proxy via env, cookies and headers per format
+    env = None
+    if ydl_opts.get('proxy'):
+        env = dict(os.environ, http_proxy=ydl_opts['proxy'], HTTP_PROXY=ydl_opts['proxy'])
+    with yt_dlp.YoutubeDL({k: v for k, v in ydl_opts.items() if k in ('cookiefile', 'cookiesfrombrowser')}) as ydl:
+        cookiejar = ydl.cookiejar
+        maps = []
+        for i, fmt in enumerate(formats):
+            if fmt.get('cookies'):
+                ydl._load_cookies(fmt['cookies'], autoscope=False)
+            cookies = cookiejar.get_cookies_for_url(fmt['url'])
+            if cookies:
+                cmd += ['-cookies', ''.join(f'{c.name}={c.value}; path={c.path}; domain={c.domain};\r\n'
+                                            for c in cookies)]
+            headers = fmt.get('http_headers') or {}
+            if headers:
+                cmd += ['-headers', ''.join(f"{k}: {v}\r\n" for k, v in headers.items())]
+            # ffmpeg reconnects by itself where yt-dlp would retry the request
+            cmd += ['-reconnect', '1', '-reconnect_on_network_error', '1', '-reconnect_delay_max', '10']
+            cmd += ['-i', fmt['url']]
+            if fmt.get('vcodec') != 'none':
+                maps += ['-map', f'{i}:v:0']
+            if fmt.get('acodec') != 'none':
+                maps += ['-map', f'{i}:a:0']
+    cmd += maps + ['-c', 'copy', '-movflags', FRAGMENTED_MP4_FLAGS, '-f', 'mp4',
+                   '-progress', 'pipe:1', '-nostats', str(out_path)]
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
+    start_streaming(download_id, out_path)
+    written = 0
+    try:
+        for line in proc.stdout:
+            if is_job_cancelled(download_id):
+                proc.kill()
+                raise Exception('Загрузка отменена пользователем')
+            key, _, value = line.strip().partition('=')
+            if key == 'total_size' and value.isdigit():
+                written = int(value)
+            elif key == 'out_time_us' and value.isdigit() and duration:
+                percent = min(int(value) / 1e6 / duration * 100, 99.9)
+                report_transfer(download_id, written, None, percent=percent)
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    if proc.returncode != 0:
+        raise Exception(f"ffmpeg завершился с кодом {proc.returncode}: {proc.stderr.read().strip()[-500:]}")
+
+def faststart_mp4(live_path, out_path, ffmpeg_path):
+    """Пишет из фрагментированного MP4 обычный с индексом в начале — для кэша и перемотки"""
+    tmp_path = out_path.with_name(out_path.name + '.part')
+    proc = subprocess.run([ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', str(live_path),
+                           '-map', '0', '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', str(tmp_path)],
+                          capture_output=True, text=True)
+    if proc.returncode != 0 or not tmp_path.is_file():
+        raise Exception((proc.stderr or '').strip()[-300:] or f'ffmpeg завершился с кодом {proc.returncode}')
+    os.replace(tmp_path, out_path)
+    remove_live_file(live_path)
+
+def remove_live_file(path):
+    # On Windows a connected /stream player keeps the file open; the tail removes it when it is done,
+    # and a leftover *.part is picked up by the storage cleanup
+    try:
+        path.unlink()
+    except OSError:
+        pass
+
+def notify_progress(download_id):
+    """Будит SSE-потоки, следящие за download_id (и за его подписчиками)"""
+    with progress_lock:
+        progress_versions[download_id] = progress_versions.get(download_id, 0) + 1
+        if not progress_waiters:
+            return
+        for job_id in (download_id, *download_followers.get(download_id, ())):
+            waiter = progress_waiters.get(job_id)
+            if waiter is not None:
+                waiter[0].notify_all()
+
+def wait_for_progress(download_id, version, timeout):
+    """Ждёт, пока версия прогресса download_id (или его ведущей загрузки) не изменится, не дольше timeout"""
+    with progress_lock:
+        waiter = progress_waiters.get(download_id)
+        if waiter is None:
+            waiter = progress_waiters[download_id] = [threading.Condition(progress_lock), 0]
+        waiter[1] += 1
+        try:
+            waiter[0].wait_for(lambda: _progress_version(download_id) != version, timeout=timeout)
+        finally:
+            waiter[1] -= 1
+            if not waiter[1]:
+                del progress_waiters[download_id]
+
+def set_progress(download_id, data):
+    """Публикует новое состояние загрузки"""
+    record = download_progress.get(download_id)
+    if record is None:
+        record = download_progress[download_id] = JobProgress(data)
+    else:
+        record.reset(data)
+        download_progress.touch(download_id)
+    notify_progress(download_id)
+    if record.status in JOURNALED_STATES:
+        journal_event(download_id, record.status, record.to_dict())
+
+def journal_event(download_id, event, data=None):
+    """Записывает событие задания в журнал; сбой журнала не должен ломать загрузку"""
+    try:
+        job_journal.record(download_id, event, data)
+    except Exception as e:
+        logger.warning(f"Не удалось записать событие {event} задания {download_id} в журнал: {e}")
+
+def report_transfer(download_id, downloaded=None, total=None, speed=None, eta=None, percent=None):
+    """Обновляет байты/скорость/ETA загрузки на месте; публикует не чаще заданного порога (True — опубликовано)"""
+    if percent is None:
+        percent = (downloaded / total) * 100 if downloaded is not None and total else 0
+    record = download_progress.get(download_id)
+    if record is None:
+        record = download_progress[download_id] = JobProgress({'status': 'downloading'})
+    now = time.monotonic()
+    if record.status == 'downloading':
+        elapsed = now - record.published_at
+        if elapsed < PROGRESS_MIN_INTERVAL:
+            return False
+        if abs(percent - record.progress) < PROGRESS_MIN_DELTA and elapsed < PROGRESS_MAX_INTERVAL:
+            return False
+    record.status = 'downloading'
+    record.progress = percent
+    record.downloaded_bytes = downloaded
+    record.total_bytes = total
+    record.speed = round(speed) if speed else None
+    record.eta = eta
+    record.published_at = now
+    notify_progress(download_id)
+    return True
+
+def output_variant(format_type, quality):
+    """Часть ключа, от которой зависит итоговый файл: качество видео или 'mp3' для перекодированного аудио"""
+    if format_type == 'video':
+        return str(quality)
+    if format_type == 'audio' and str(quality) == 'mp3':
+        return 'mp3'
+    return ''
+
+def job_key(url, format_type, quality):
+    """Ключ для объединения одинаковых загрузок"""
+    # youtu.be/X, watch?v=X&t=30 and shorts/X all map to the same job
+    media = canonicalize_url(url) or normalize_url(url)
+    # quality only affects the output file for video (and mp3 vs passthrough for audio)
+    return (media, format_type, output_variant(format_type, quality))
+
+def attach_or_register(key, download_id):
+    """Подписывает download_id на выполняющуюся загрузку с тем же ключом.
+
+    Возвращает download_id ведущей загрузки, либо None, если download_id сам стал ведущим.
+    """
+    with inflight_lock:
+        leader = inflight_jobs.get(key)
+        if leader is not None and not _job_cancelled_locked(leader):
+            download_aliases[download_id] = leader
+            download_followers.setdefault(leader, set()).add(download_id)
+            return leader
+        inflight_jobs[key] = download_id
+        inflight_keys[download_id] = key
+        return None
+
+def release_inflight(download_id):
+    """Снимает регистрацию ведущей загрузки — новые запросы снова запустят задание"""
+    with inflight_lock:
+        key = inflight_keys.pop(download_id, None)
+        if key is not None and inflight_jobs.get(key) == download_id:
+            del inflight_jobs[key]
+
+def resolve_download_id(download_id):
+    """download_id ведущей загрузки для подписчика (или сам download_id)"""
+    return download_aliases.get(download_id, download_id)
+
+def _job_cancelled_locked(leader):
+    if not download_cancelled.get(leader):
+        return False
+    return all(download_cancelled.get(f) for f in download_followers.get(leader, ()))
+
+def is_job_cancelled(leader):
+    """Задание отменено, только если его отменили все подписанные клиенты"""
+    with inflight_lock:
+        return _job_cancelled_locked(leader)
+
+def run_download_job(url, format_type, quality, download_id, user_ip, check_downloaded=None, stream=False):
+    """Выполняет загрузку и освобождает её single-flight ключ"""
+    journal_event(download_id, 'running')
+    site = site_of_url(url)
+    transfer_sites[download_id] = site
+    try:
+        # make room before writing so the volume does not fill up mid-download
+        storage.maybe_evict()
+    except Exception as e:
+        logger.warning(f"Ошибка очистки места: {e}")
+    try:
+        download_media(url, format_type, quality, download_id, user_ip, check_downloaded, stream)
+    finally:
+        record = download_progress.get(download_id)
+        METRIC_JOBS_FINISHED.inc(site=site, status=record.status if record else 'unknown')
+        transfer_seen.pop(download_id, None)
+        transfer_sites.pop(download_id, None)
+        transfer_finished_at.pop(download_id, None)
+        release_inflight(download_id)
+        stream_candidates.pop(download_id, None)
+        streaming_files.pop(download_id, None)
+
+def submit_job(download_id, url, format_type, quality, user_ip, check_downloaded=None, stream=False):
+    """Ставит ведущее задание в очередь пула; False — очередь заполнена"""
+    set_progress(download_id, {
+        'progress': 0,
+        'status': 'queued'
+    })
+    if not download_pool.submit(download_id, run_download_job, url, format_type, quality, download_id, user_ip,
+                                check_downloaded, stream):
+        release_inflight(download_id)
+        download_progress.pop(download_id, None)
+        return False
+    return True
+
+def restore_jobs():
+    """Поднимает состояние заданий из журнала: готовые отвечают на /progress, незавершённые снова в очереди"""
+    try:
+        job_journal.compact(time.time() - JOB_JOURNAL_RETENTION)
+        jobs = job_journal.replay()
+    except Exception as e:
+        logger.error(f"Не удалось прочитать журнал заданий: {e}")
+        return 0
+    resumed = 0
+    for download_id, job in jobs.items():
+        if job['cancelled']:
+            download_cancelled[download_id] = True
+        if job['state'] in JOURNALED_STATES:
+            download_progress[download_id] = JobProgress(job['result'] or {})
+        elif job['state'] in ('queued', 'running') and job['params']:
+            if job['cancelled']:
+                continue
+            if job['attempts'] >= MAX_RESUME_ATTEMPTS:
+                logger.warning(f"Задание {download_id} прерывалось {job['attempts']} раз, больше не продолжаем")
+                set_progress(download_id, {
+                    'progress': 0,
+                    'status': 'error',
+                    'error': 'Загрузка прервана перезапуском сервера'
+                })
+                continue
+            params = job['params']
+            leader = attach_or_register(job_key(params['url'], params['format'], params['quality']), download_id)
+            if leader is not None:
+                journal_event(download_id, 'attached', {'leader': leader})
+                continue
+            if submit_job(download_id, params['url'], params['format'], params['quality'], params['user_ip'],
+                          params['check_downloaded'], params['stream']):
+                resumed += 1
+    # followers go after their leaders so the alias points at a known job
+    with inflight_lock:
+        for download_id, job in jobs.items():
+            leader = job['leader']
+            if job['state'] == 'attached' and leader in download_progress:
+                download_aliases[download_id] = leader
+                download_followers.setdefault(leader, set()).add(download_id)
+    logger.info(f"Журнал заданий: восстановлено {len(jobs)}, снова в очереди {resumed}")
+    return resumed
+
+def start_streaming(download_id, path):
+    """Открывает /stream/<download_id> для файла, который сейчас пишется"""
+    streaming_files[download_id] = Path(path)
+    record = download_progress.get(download_id)
+    if record is not None:
+        record.stream_url = f'/stream/{download_id}'
+        notify_progress(download_id)
+
+def count_transferred(d, download_id):
+    """Добавляет в метрику байты, скачанные с прошлого учёта (вызывается при публикации прогресса и в конце файла)"""
+    downloaded = d.get('downloaded_bytes') or d.get('total_bytes')
+    if not downloaded:
+        return
+    # count only the growth since the previous call for this file
+    seen = transfer_seen.setdefault(download_id, {})
+    # 'finished' carries only the final name, so key by it rather than by the .part name
+    part = d.get('filename') or d.get('tmpfilename')
+    delta = downloaded - seen.get(part, 0)
+    if delta > 0:
+        seen[part] = downloaded
+        METRIC_DOWNLOADED_BYTES.inc(delta, site=transfer_sites.get(download_id, 'other'))
+
+def progress_hook(d, download_id):
+    """Обработчик прогресса загрузки"""
+    # If every client of this job requested cancel, raise to abort yt-dlp
+    if is_job_cancelled(download_id):
+        raise Exception('Загрузка отменена пользователем')
+    if d['status'] == 'downloading':
+        expected = stream_candidates.get(download_id)
+        if expected is not None and download_id not in streaming_files and d.get('filename'):
+            # Only a single-file HTTP download written straight to its final name can be read
+            # while it grows (merge parts are named <stem>.f<id>.<ext> and fragments are not playable)
+            written = Path(d['filename'])
+            fmt = d.get('info_dict') or {}
+            if (written.stem == expected.stem and d.get('tmpfilename', d['filename']) == d['filename']
+                    and fmt.get('protocol') in ('http', 'https')):
+                start_streaming(download_id, written)
+        try:
+            # Извлекаем прогресс из байтов или строки
+            downloaded = d.get('downloaded_bytes')
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            percent = None
+            if downloaded is None or not total:
+                percent_str = (d.get('_percent_str') or '').strip().replace('%', '')
+                percent = float(percent_str) if percent_str else 0
+            if report_transfer(download_id, downloaded, total, d.get('speed'), d.get('eta'), percent):
+                count_transferred(d, download_id)
+        except Exception as e:
+            logger.error(f"Ошибка обработки прогресса: {e}")
+    
+    elif d['status'] == 'finished':
+        count_transferred(d, download_id)
+        transfer_finished_at[download_id] = time.monotonic()
+        record = download_progress.get(download_id)
+        if record is not None:
+            record.progress = 100
+            record.status = 'processing'
+            record.speed = record.eta = None
+            notify_progress(download_id)
+
+def lookup_cached_file(site, media_id, format_type, quality):
+    """Запись каталога для уже скачанного файла, если он всё ещё на диске"""
+    entry = catalog.find(site, media_id, format_type, output_variant(format_type, quality))
+    if entry and not (DOWNLOADS_DIR / entry['filename']).exists():
+        # file was deleted behind our back
+        catalog.remove(entry['filename'])
+        return None
+    return entry
+
+def lookup_higher_quality(site, media_id, quality):
+    """Уже скачанное видео ближайшего качества выше запрошенного"""
+    if not str(quality).isdigit():
+        return None
+    higher = [entry for entry in catalog.find_largest(site, media_id, 'video')
+              if str(entry['quality']).isdigit() and int(entry['quality']) > int(quality)]
+    for entry in reversed(higher):
+        if (DOWNLOADS_DIR / entry['filename']).is_file():
+            return entry
+    return None
+
+def complete_from_cache(download_id, entry, format_type, url, user_ip, timings=None):
+    """Помечает загрузку завершённой уже имеющимся файлом"""
+    METRIC_FILE_CACHE.inc(result='hit')
+    # the client asks /file right after "completed": keep the cleanup away from it until then
+    storage.mark_served(entry['filename'])
+    set_progress(download_id, {
+        'progress': 100,
+        'status': 'completed',
+        'filename': entry['filename'],
+        'format': format_type,
+        'variant': entry['quality'] or None,
+        'timings': timings.as_dict() if timings else None
+    })
+    event_log.emit('cache_hit', job_id=download_id, phase='lookup', user=user_ip, url=url, file=entry['filename'],
+                   format=format_type, bytes=entry['size'], durations=timings.as_dict() if timings else None)
+
+def serve_cached_variant(download_id, site, media_id, quality, url, user_ip, timings):
+    """Видео другого качества из кэша по VIDEO_CACHE_POLICY. True, если задание завершено без сети"""
+    if VIDEO_CACHE_POLICY not in ('serve-higher', 'downscale'):
+        return False
+    with timings.phase('lookup'):
+        entry = lookup_higher_quality(site, media_id, quality)
+    if entry is None:
+        return False
+    if VIDEO_CACHE_POLICY == 'downscale' and downscale_cached_video(download_id, entry, quality, url, user_ip, timings):
+        return True
+    complete_from_cache(download_id, entry, 'video', url, user_ip, timings)
+    return True
+
+def downscale_cached_video(download_id, source, quality, url, user_ip, timings):
+    """Уменьшает уже скачанное видео до запрошенной высоты (звук копируется)"""
+    caps = get_ffmpeg_caps()
+    if not caps.available or not (caps.has_encoder('libx264') or not caps.encoders):
+        return False
+    source_path = DOWNLOADS_DIR / source['filename']
+    storage.mark_served(source_path.name)
+    out_path = DOWNLOADS_DIR / f"video_{source['media_id']}_{short_title(source['title'])}_{quality}.mp4"
+    tmp_path = out_path.with_name(out_path.name + '.part')
+    # min(...) keeps a file labelled 1080 but really 720 from being upscaled
+    cmd = [caps.path, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', str(source_path),
+           '-vf', f'scale=-2:min({int(quality)}\\,ih)', '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+           '-c:a', 'copy', '-movflags', '+faststart', '-f', 'mp4', str(tmp_path)]
+
+    def downscale():
+        started = time.monotonic()
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0 or not tmp_path.is_file() or tmp_path.stat().st_size == 0:
+            raise Exception((proc.stderr or '').strip()[-300:] or f'ffmpeg завершился с кодом {proc.returncode}')
+        os.replace(tmp_path, out_path)
+        return time.monotonic() - started
+
+    try:
+        elapsed, wait = run_postprocess(download_id, downscale, release_slot=False)
+    except Exception as e:
+        if is_job_cancelled(download_id):
+            raise
+        logger.warning(f"Не удалось уменьшить {source_path.name} до {quality}p: {e}")
+        METRIC_FALLBACKS.inc(path='downscale_cached', result='failure')
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        return False
+    if wait:
+        timings.record('postprocess_queue', wait)
+    timings.record('postprocess', elapsed)
+    METRIC_FILE_CACHE.inc(result='derived')
+    METRIC_OUTPUT_PATH.inc(format='video', path='downscale')
+    METRIC_POSTPROCESS_SECONDS.observe(elapsed, site=source['site'] or 'other', path='downscale')
+
+    phase_times = timings.as_dict()
+    size = out_path.stat().st_size
+    try:
+        catalog.add(out_path.name, site=source['site'], media_id=source['media_id'], url=source['url'],
+                    format='video', quality=str(quality), title=source['title'], uploader=source['uploader'],
+                    method='derived', size=size, timings=json.dumps(phase_times), postprocess='downscale')
+    except Exception as e:
+        logger.warning(f"Не удалось записать файл в каталог: {e}")
+    set_progress(download_id, {
+        'progress': 100,
+        'status': 'completed',
+        'filename': out_path.name,
+        'format': 'video',
+        'variant': str(quality),
+        'timings': phase_times
+    })
+    event_log.emit('completed', job_id=download_id, phase='done', user=user_ip, url=url, file=out_path.name,
+                   format='video', method='derived', quality=quality, bytes=size, durations=phase_times,
+                   message=f"downscaled from {source['quality']}p ({source_path.name})")
+    return True
+
+def short_title(title):
+    """Часть имени файла из названия ролика"""
+    title = re.sub(r"[^0-9A-Za-zА-Яа-я_\- ]+", '', title or 'media')
+    return title.strip().replace(' ', '_')[:60]
+
+def derive_from_cached_video(download_id, site, media_id, format_type, quality, url, user_ip, timings):
+    """Аудио или картинка из уже скачанного видео этого ролика — локально через ffmpeg, без сети.
+
+    Возвращает True, если задание завершено; при любой неудаче загрузка идёт обычным путём.
+    """
+    if format_type not in ('audio', 'photo'):
+        return False
+    caps = get_ffmpeg_caps()
+    if not caps.available:
+        return False
+    with timings.phase('lookup'):
+        source = None
+        for entry in catalog.find_largest(site, media_id, 'video'):
+            candidate = DOWNLOADS_DIR / entry['filename']
+            if candidate.suffix in DERIVE_SOURCE_EXTS and candidate.is_file():
+                source = entry
+                break
+    if source is None:
+        return False
+
+    source_path = DOWNLOADS_DIR / source['filename']
+    # keep the source away from the storage cleanup while ffmpeg reads it
+    storage.mark_served(source_path.name)
+    title_short = short_title(source['title'])
+    cmd = [caps.path, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', str(source_path)]
+    if format_type == 'photo':
+        out_path = DOWNLOADS_DIR / f"photo_{media_id}_{title_short}.jpg"
+        cmd += ['-vf', 'thumbnail', '-frames:v', '1', '-q:v', '2', '-f', 'image2']
+        path = 'frame'
+    elif output_variant('audio', quality) == 'mp3':
+        if caps.has_encoder('libmp3lame') or not caps.encoders:
+            out_path = DOWNLOADS_DIR / f"audio_{media_id}_{title_short}.mp3"
+            cmd += ['-vn', '-map', '0:a:0', '-c:a', 'libmp3lame', '-b:a', AUDIO_MP3_BITRATE + 'k', '-f', 'mp3']
+        else:
+            out_path = DOWNLOADS_DIR / f"audio_{media_id}_{title_short}.m4a"
+            cmd += ['-vn', '-map', '0:a:0', '-c:a', 'aac', '-b:a', AUDIO_MP3_BITRATE + 'k', '-f', 'mp4']
+        path = 'transcode'
+    else:
+        # the audio track is copied as is into a container of the same family
+        container = 'webm' if source_path.suffix == '.webm' else 'mp4'
+        ext = 'webm' if container == 'webm' else 'm4a'
+        out_path = DOWNLOADS_DIR / f"audio_{media_id}_{title_short}_orig.{ext}"
+        cmd += ['-vn', '-map', '0:a:0', '-c:a', 'copy', '-f', container]
+        path = 'remux'
+    tmp_path = out_path.with_name(out_path.name + '.part')
+    cmd.append(str(tmp_path))
+
+    def extract():
+        started = time.monotonic()
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0 or not tmp_path.is_file() or tmp_path.stat().st_size == 0:
+            raise Exception((proc.stderr or '').strip()[-300:] or f'ffmpeg завершился с кодом {proc.returncode}')
+        os.replace(tmp_path, out_path)
+        return time.monotonic() - started
+
+    try:
+        # the slot stays with this job: if ffmpeg fails, the job goes on to a normal download
+        elapsed, wait = run_postprocess(download_id, extract, release_slot=False)
+    except Exception as e:
+        if is_job_cancelled(download_id):
+            raise
+        logger.warning(f"Не удалось получить {format_type} из {source_path.name}, загрузка из сети: {e}")
+        METRIC_FALLBACKS.inc(path='derive_from_video', result='failure')
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        return False
+    if wait:
+        timings.record('postprocess_queue', wait)
+    timings.record('postprocess', elapsed)
+    METRIC_FILE_CACHE.inc(result='derived')
+    METRIC_OUTPUT_PATH.inc(format=format_type, path=path)
+    METRIC_POSTPROCESS_SECONDS.observe(elapsed, site=site, path=path)
+
+    phase_times = timings.as_dict()
+    size = out_path.stat().st_size
+    try:
+        catalog.add(out_path.name, site=site, media_id=media_id, url=source['url'], format=format_type,
+                    quality=output_variant(format_type, quality), title=source['title'],
+                    uploader=source['uploader'], method='derived', size=size,
+                    timings=json.dumps(phase_times), postprocess=path)
+    except Exception as e:
+        logger.warning(f"Не удалось записать файл в каталог: {e}")
+    set_progress(download_id, {
+        'progress': 100,
+        'status': 'completed',
+        'filename': out_path.name,
+        'format': format_type,
+        'timings': phase_times
+    })
+    event_log.emit('completed', job_id=download_id, phase='done', user=user_ip, url=url, file=out_path.name,
+                   format=format_type, method='derived', quality=quality, bytes=size, durations=phase_times,
+                   message=f'derived from {source_path.name} ({path})')
+    return True
+
+def choose_audio_output(info, quality, caps):
+    """Как получить аудио: формат для yt-dlp, постобработка и режим (direct / remux / transcode).
+
+    По умолчанию берётся лучшая аудиодорожка без перекодирования: m4a/mp3 сохраняются как есть,
+    остальное (Opus/Vorbis в webm, звук из видеофайла) переупаковывается ffmpeg копированием потока.
+    """
+    if output_variant('audio', quality) == 'mp3':
+        # builds without LAME cannot write mp3; AAC has a native encoder in every build
+        codec = 'mp3' if caps.has_encoder('libmp3lame') or not caps.encoders else 'm4a'
+        return {
+            'format': 'bestaudio/best',
+            'postprocessors': [{'key': 'ExtractAudio', 'preferredcodec': codec,
+                                'preferredquality': AUDIO_MP3_BITRATE}],
+            'mode': 'transcode',
+        }
+    audio_only = [f for f in (info or {}).get('formats') or []
+                  if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none') and f.get('url')]
+
+    def bitrate(f):
+        return f.get('abr') or f.get('tbr') or 0
+
+    direct = [f for f in audio_only if f.get('ext') in AUDIO_DIRECT_EXTS]
+    if direct:
+        # a browser-playable track is kept byte for byte, no ffmpeg at all
+        best = max(direct, key=bitrate)
+        return {'format': f"{best['format_id']}/bestaudio[ext=m4a]/bestaudio", 'postprocessors': [],
+                'mode': 'direct'}
+    if not caps.path:
+        # nothing to remux with: keep whatever container the best track comes in; without an
+        # audio-only format yt-dlp fails the job instead of saving the whole video as "audio"
+        return {'format': 'bestaudio', 'postprocessors': [], 'mode': 'direct'}
+    # 'best' makes FFmpegExtractAudio copy the stream into its natural container (aac->m4a, opus->opus)
+    return {
+        'format': 'bestaudio/best',
+        'postprocessors': [{'key': 'ExtractAudio', 'preferredcodec': 'best'}],
+        'mode': 'remux',
+    }
+
+# Кодеки, которые кладутся в MP4 без перекодирования (остальные требуют FFmpegVideoConvertor)
+MP4_VIDEO_CODECS = ('avc1', 'avc3', 'h264', 'hev1', 'hvc1', 'h265', 'hevc', 'av01')
+MP4_AUDIO_CODECS = ('mp4a', 'aac', 'mp3', 'ac-3', 'ec-3')
+
+def _mp4_compatible(fmt):
+    for key, allowed in (('vcodec', MP4_VIDEO_CODECS), ('acodec', MP4_AUDIO_CODECS)):
+        codec = (fmt.get(key) or '').lower()
+        if codec == 'none':
+            continue
+        if not codec:
+            # codec not reported: trust an mp4 container, anything else is unknown
+            if fmt.get('ext') != 'mp4':
+                return False
+            continue
+        if not codec.startswith(allowed):
+            return False
+    return True
+
+def plan_video_output(ydl_opts, info, convert_incompatible):
+    """Выбирает постобработку видео по кодекам выбранных форматов и меняет ydl_opts на месте.
+
+    none    — один mp4-файл с mp4-кодеками, ffmpeg не нужен;
+    merge   — видео и аудио склеиваются в mp4 копированием потоков;
+    remux   — кодеки подходят, меняется только контейнер (FFmpegVideoRemuxer, без перекодирования);
+    convert — кодеки не кладутся в mp4, перекодирование (только там, где mp4 обязателен);
+    keep    — несовместимые кодеки остаются в исходном контейнере.
+    """
+    try:
+        formats = select_formats(ydl_opts, info) if info else []
+    except Exception as e:
+        logger.info(f"Не удалось заранее определить форматы, постобработка по умолчанию: {e}")
+        formats = []
+    if not formats:
+        return 'convert' if ydl_opts.get('postprocessors') else 'keep'
+    if all(_mp4_compatible(f) for f in formats):
+        ydl_opts.pop('postprocessors', None)
+        if len(formats) > 1:
+            return 'merge'
+        if formats[0].get('ext') == 'mp4':
+            return 'none'
+        ydl_opts['postprocessors'] = [{'key': 'VideoRemuxer', 'preferedformat': 'mp4'}]
+        return 'remux'
+    if convert_incompatible:
+        ydl_opts['postprocessors'] = [{'key': 'VideoConvertor', 'preferedformat': 'mp4'}]
+        return 'convert'
+    ydl_opts.pop('postprocessors', None)
+    return 'keep'
+
+def actual_output_path(format_type, planned, ran):
+    """Путь постобработки по тому, что yt-dlp действительно запускал (план может не сработать)"""
+    if format_type == 'audio':
+        # ExtractAudio skips files already in the target codec
+        return planned if 'ExtractAudio' in ran else 'direct'
+    if format_type != 'video':
+        return planned
+    for key, path in (('VideoConvertor', 'convert'), ('VideoRemuxer', 'remux'), ('Merger', 'merge')):
+        if key in ran:
+            return path
+    return 'keep' if planned == 'keep' else 'none'
+
+def build_ydl_opts(url, format_type, quality, filepath, download_id, resumable, caps, info=None):
+    """Опции yt-dlp для задания с учётом возможностей найденного ffmpeg.
+
+    Возвращает (ydl_opts, запланированный путь постобработки); что реально выполнилось,
+    определяет actual_output_path() после загрузки.
+    """
+    output_path = None
+    ydl_opts = {
+        'outtmpl': str(filepath.with_suffix('.%(ext)s')),
+        'quiet': True,
+        'no_warnings': True,
+        'progress_hooks': [lambda d: progress_hook(d, download_id)],
+        # .part + continuedl: an interrupted download continues with a Range request instead of
+        # starting from byte zero (yt-dlp treats 416 on an already complete .part as finished).
+        # Streaming reads the file under its final name while it grows, so it keeps nopart.
+        'nopart': not resumable,
+        'continuedl': True,
+    }
+    # ffmpeg was located and probed once (get_ffmpeg_caps); tell yt-dlp where it is.
+    # ffmpeg_path stays None when the binary cannot write MP4, so the merge-free formats below are used.
+    ffmpeg_path = caps.path if caps.can_merge_mp4 else None
+    if caps.path:
+        # yt-dlp accepts 'ffmpeg_location' pointing to ffmpeg binary or folder
+        # provide the parent folder so yt-dlp can find all helpers
+        ydl_opts['ffmpeg_location'] = str(Path(caps.path).parent)
+
+    if format_type == 'audio':
+        audio = choose_audio_output(info, quality, caps)
+        ydl_opts['format'] = audio['format']
+        if audio['postprocessors']:
+            ydl_opts['postprocessors'] = audio['postprocessors']
+        output_path = audio['mode']
+        # audio_lang option removed — yt-dlp will pick default audio
+    else:
+        # Для YouTube: выбираем bestvideo+bestaudio с максимальным битрейтом и mp4
+        # Формат: bestvideo[ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best
+        # Для других сайтов fallback на старую схему
+        if 'youtube.com' in url or 'youtu.be' in url:
+            quality_map = {
+                '1080': 'bestvideo[height<=1080][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
+                '720': 'bestvideo[height<=720][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
+                '480': 'bestvideo[height<=480][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
+                '360': 'bestvideo[height<=360][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
+            }
+            # If ffmpeg is missing, avoid requesting a merge of separate video+audio since that will fail.
+            if ffmpeg_path:
+                ydl_opts.update({
+                    'format': quality_map.get(quality, 'bestvideo+bestaudio/best'),
+                    'merge_output_format': 'mp4',
+                })
+            else:
+                # Fallback: request the best single file (may already contain combined streams)
+                logger.warning('ffmpeg not found — falling back to best single-file format to avoid merge error')
+                ydl_opts.update({
+                    'format': 'best',
+                })
+        else:
+            # Для TikTok и других сайтов, где может потребоваться перекодирование,
+            # используем postprocessor для гарантии mp4.
+            if 'tiktok.com' in url:
+                ydl_opts.update({
+                    'format': 'bestvideo+bestaudio/best',
+                    'postprocessors': [{
+                        'key': 'FFmpegVideoConvertor',
+                        'preferedformat': 'mp4',
+                    }],
+                    'merge_output_format': 'mp4',
+                })
+                # Если ffmpeg нет, то слияние и конвертация не сработают, поэтому лучше выбрать лучший одиночный файл
+                if not ffmpeg_path:
+                    logger.warning('ffmpeg not found — falling back to best single-file format for TikTok')
+                    ydl_opts.pop('postprocessors', None)
+                    ydl_opts['format'] = 'best'
+                else:
+                    # TikTok mostly serves H.264/AAC mp4: convert only what really cannot go into mp4
+                    output_path = plan_video_output(ydl_opts, info, convert_incompatible=True)
+            else:
+                quality_map = {
+                    '1080': 'best[height<=1080]/bestvideo[height<=1080]+bestaudio/best',
+                    '720': 'best[height<=720]/bestvideo[height<=720]+bestaudio/best',
+                    '480': 'best[height<=480]/bestvideo[height<=480]+bestaudio/best',
+                    '360': 'best[height<=360]/bestvideo[height<=360]+bestaudio/best',
+                }
+                if ffmpeg_path:
+                    ydl_opts.update({
+                        'format': quality_map.get(quality, 'best'),
+                        'merge_output_format': 'mp4',
+                    })
+                else:
+                    logger.warning('ffmpeg not found — falling back to best single-file format to avoid merge error')
+                    ydl_opts.update({
+                        'format': 'best',
+                    })
+
+    # Special-case tweaks for Pinterest which sometimes lacks normal formats
+    try:
+        if 'pinterest.com' in url.lower() or 'pin.it' in url.lower():
+            # try settings that help with HLS / unusual containers
+            ydl_opts.update({
+                'hls_prefer_native': True,
+                'allow_unplayable_formats': True,
+                # try prefer native best as initial attempt
+                'format': ydl_opts.get('format', 'best')
+            })
+            logger.info('Applying Pinterest-friendly yt-dlp options')
+    except Exception:
+        pass
+
+    if format_type == 'video' and output_path is None:
+        youtube = 'youtube.com' in url or 'youtu.be' in url
+        if ffmpeg_path and not youtube:
+            # other sites: a compatible non-mp4 single file is remuxed, the rest kept as before
+            output_path = plan_video_output(ydl_opts, info, convert_incompatible=False)
+        else:
+            output_path = 'merge' if ffmpeg_path else 'none'
+    return ydl_opts, output_path
+
+def download_media(url, format_type, quality, download_id, user_ip, check_downloaded=None, stream=False):
+    """Функция загрузки медиа (выполняется рабочим потоком из download_pool)"""
+    if is_job_cancelled(download_id):
+        return
+    # Per-phase timings (monotonic): returned in /progress and stored in the catalog row
+    timings = PhaseTimer()
+    record = download_progress.get(download_id)
+    if record is not None and record.status == 'queued':
+        timings.record('queue', timings.started - record.published_at)
+    try:
+        # determine whether to honor existing files for this download (per-request overrides global)
+        effective_check = CHECK_DOWNLOADED if check_downloaded is None else bool(check_downloaded)
+        derive_tried = False
+
+        # Fast path: the media id is visible in the URL, so an existing file is found without yt-dlp
+        canon = canonicalize_url(url)
+        if canon and effective_check:
+            with timings.phase('lookup'):
+                cached_entry = lookup_cached_file(canon[0], canon[1], format_type, quality)
+            if cached_entry:
+                complete_from_cache(download_id, cached_entry, format_type, url, user_ip, timings)
+                return
+            if derive_from_cached_video(download_id, canon[0], canon[1], format_type, quality, url, user_ip, timings):
+                return
+            derive_tried = True
+            if format_type == 'video' and serve_cached_variant(download_id, canon[0], canon[1], quality, url,
+                                                               user_ip, timings):
+                return
+
+        # Получим метаданные (id/title) через extract_info, без загрузки (или из кэша)
+        site = site_of_url(url)
+        with timings.phase('extract'):
+            info = extract_info_cached(url)
+        METRIC_EXTRACT_SECONDS.observe(timings.get('extract'), site=site)
+
+        if not info:
+            raise Exception("Не удалось получить информацию о видео. Проверьте ссылку.")
+
+        video_id = info.get('id') or str(uuid.uuid4())
+        title_short = short_title(info.get('title'))
+
+        # Deterministic filename using video id, format and quality
+        if format_type == 'audio':
+            if output_variant(format_type, quality) == 'mp3':
+                ext = 'mp3'
+                filename = f"audio_{video_id}_{title_short}.{ext}"
+            else:
+                # the real extension follows the source codec (m4a / opus / mp3 / ogg)
+                ext = 'm4a'
+                filename = f"audio_{video_id}_{title_short}_orig.{ext}"
+        elif format_type == 'photo':
+            # photos we'll save as JPGs
+            ext = 'jpg'
+            filename = f"photo_{video_id}_{title_short}.{ext}"
+        else:
+            ext = 'mp4'
+            filename = f"video_{video_id}_{title_short}_{quality}.{ext}"
+
+        filepath = DOWNLOADS_DIR / filename
+        # Fields stored in the catalog for every file produced by this job
+        catalog_fields = {
+            'site': site_of_url(info.get('webpage_url') or url),
+            'media_id': video_id,
+            'url': canonical_url(url),
+            'format': format_type,
+            'quality': output_variant(format_type, quality),
+            'title': info.get('title'),
+            'uploader': info.get('uploader'),
+        }
+
+    # If file already exists, skip download and mark completed
+        with timings.phase('lookup'):
+            cached_entry = lookup_cached_file(catalog_fields['site'], video_id, format_type, quality)
+        if cached_entry:
+            if effective_check:
+                complete_from_cache(download_id, cached_entry, format_type, url, user_ip, timings)
+                return
+            else:
+                # When CHECK_DOWNLOADED is False, remove existing file and proceed to redownload
+                # the stored file may use another extension than the deterministic name
+                cached_path = DOWNLOADS_DIR / cached_entry['filename']
+                # legacy metadata file written by older versions
+                meta_file = cached_path.with_suffix(cached_path.suffix + '.json')
+                try:
+                    existing_size = cached_entry['size']
+                    cached_path.unlink()
+                    catalog.remove(cached_path.name)
+                    # Also try to remove legacy metadata file if exists
+                    try:
+                        if meta_file.exists():
+                            meta_file.unlink()
+                    except Exception:
+                        pass
+                    event_log.emit('redownload', job_id=download_id, phase='lookup', user=user_ip, url=url,
+                                   file=cached_path.name, format=format_type, bytes=existing_size,
+                                   message='removed existing file')
+                except Exception as e:
+                    # If we couldn't remove, still try to continue but log
+                    event_log.emit('warning', job_id=download_id, phase='lookup', user=user_ip, url=url,
+                                   file=cached_path.name, message=f'failed to remove existing file: {e}')
+        if effective_check and not derive_tried and derive_from_cached_video(download_id, catalog_fields['site'], video_id, format_type,
+                                                        quality, url, user_ip, timings):
+            return
+        if (effective_check and not derive_tried and format_type == 'video'
+                and serve_cached_variant(download_id, catalog_fields['site'], video_id, quality, url, user_ip, timings)):
+            return
+        METRIC_FILE_CACHE.inc(result='miss')
+
+        # Handle photo format: try to download thumbnail or image URL from info
+        if format_type == 'photo':
+            # info may contain thumbnails
+            thumbnail_url = None
+            if 'thumbnail' in info and info['thumbnail']:
+                thumbnail_url = info['thumbnail']
+            else:
+                # try thumbnails list
+                thumbs = info.get('thumbnails') or info.get('thumbnails')
+                if thumbs and isinstance(thumbs, list) and len(thumbs) > 0:
+                    thumbnail_url = thumbs[-1].get('url')
+
+            # If no thumbnail found via yt-dlp metadata, attempt site-specific scrape for Pinterest images
+            def try_pinterest_image_download(page_url, out_path):
+                try:
+                    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
+                    r = requests.get(page_url, headers=headers, timeout=15)
+                    r.raise_for_status()
+                    html = r.text
+                    # Try og:image
+                    m = re.search(r'<meta[^>]+property=["\']og:image["\'][^>]+content=["\']([^"\']+)["\']', html, re.I)
+                    if not m:
+                        # Look for JSON LD or initial state with images
+                        m = re.search(r'"images":\s*\[\s*\{[^\}]*"url":"([^"]+)"', html)
+                    if not m:
+                        # fallback to first <img src=...> in the pin content area
+                        m = re.search(r'<img[^>]+src=["\']([^"\']+)["\'][^>]*class=["\'][^"\']*pinImage[^"\']*["\']', html, re.I)
+                    if not m:
                         # more generic img tag fallback
                         m = re.search(r'<img[^>]+src=["\']([^"\']+)["\']', html, re.I)
                     if m:
@@ -1118,18 +3442,12 @@ def download_media(url, format_type, quality, download_id, user_ip, check_downlo
                             for chunk in rr.iter_content(8192):
                                 if chunk:
                                     ofh.write(chunk)
-                        # write metadata
+                        # register in catalog
                         try:
-                            metadata = {
-                                'url': page_url,
-                                'downloaded_at': datetime.datetime.now().isoformat(),
-                                'method': 'pinterest_image_scrape',
-                                'source_image': img_url
-                            }
-                            with open(out_path.with_suffix(out_path.suffix + '.json'), 'w', encoding='utf-8') as mf:
-                                json.dump(metadata, mf, ensure_ascii=False, indent=2)
-                        except Exception:
-                            pass
+                            catalog.add(out_path.name, method='pinterest_image_scrape',
+                                        size=out_path.stat().st_size, **catalog_fields)
+                        except Exception as e:
+                            logger.warning(f"Не удалось записать файл в каталог: {e}")
                         return True
                     return False
                 except Exception as e:
@@ -1138,35 +3456,30 @@ def download_media(url, format_type, quality, download_id, user_ip, check_downlo
 
             if thumbnail_url:
                 try:
-                    resp = requests.get(thumbnail_url, timeout=15)
-                    resp.raise_for_status()
-                    with open(filepath, 'wb') as f:
-                        f.write(resp.content)
-
-                    # write metadata
-                    metadata = {
-                        'url': url,
-                        'title': info.get('title'),
-                        'id': video_id,
-                        'format': 'photo',
-                        'downloaded_at': datetime.datetime.now().isoformat(),
-                        'source_thumbnail': thumbnail_url,
-                        'file_size': filepath.stat().st_size
-                    }
+                    with timings.phase('transfer'):
+                        resp = requests.get(thumbnail_url, timeout=15)
+                        resp.raise_for_status()
+                        with open(filepath, 'wb') as f:
+                            f.write(resp.content)
+
+                    # register in catalog
+                    phase_times = timings.as_dict()
                     try:
-                        with open(meta_file, 'w', encoding='utf-8') as mf:
-                            json.dump(metadata, mf, ensure_ascii=False, indent=2)
-                    except Exception:
-                        pass
+                        catalog.add(filepath.name, method='thumbnail', size=filepath.stat().st_size,
+                                    timings=json.dumps(phase_times), **catalog_fields)
+                    except Exception as e:
+                        logger.warning(f"Не удалось записать файл в каталог: {e}")
 
-                    download_progress[download_id] = {
+                    set_progress(download_id, {
                         'progress': 100,
                         'status': 'completed',
                         'filename': filepath.name,
-                        'format': 'photo'
-                    }
-                    with open(LOG_FILE, 'a', encoding='utf-8') as lf:
-                        lf.write(f"[{datetime.datetime.now().isoformat()}] PHOTO DOWNLOADED | user: {user_ip} | url: {url} | file: {filepath.name} | size: {filepath.stat().st_size}\n")
+                        'format': 'photo',
+                        'timings': phase_times
+                    })
+                    event_log.emit('completed', job_id=download_id, phase='done', user=user_ip, url=url,
+                                   file=filepath.name, format='photo', method='thumbnail',
+                                   bytes=filepath.stat().st_size, durations=phase_times)
                     return
                 except Exception as e:
                     raise Exception(f"Не удалось скачать изображение: {e}")
@@ -1175,118 +3488,31 @@ def download_media(url, format_type, quality, download_id, user_ip, check_downlo
                 if ('pinterest.com' in url.lower() or 'pin.it' in url.lower()):
                     # ensure photo filenames use .jpg
                     out_path = filepath.with_suffix('.jpg')
-                    success = try_pinterest_image_download(url, out_path)
+                    with timings.phase('transfer'):
+                        success = try_pinterest_image_download(url, out_path)
+                    METRIC_FALLBACKS.inc(path='pinterest_image_scrape', result='success' if success else 'failure')
                     if success and out_path.exists():
-                        download_progress[download_id] = {
+                        phase_times = timings.as_dict()
+                        catalog.set_timings(out_path.name, phase_times)
+                        set_progress(download_id, {
                             'progress': 100,
                             'status': 'completed',
                             'filename': out_path.name,
-                            'format': 'photo'
-                        }
-                        with open(LOG_FILE, 'a', encoding='utf-8') as lf:
-                            lf.write(f"[{datetime.datetime.now().isoformat()}] PINTEREST PHOTO SCRAPED | user: {user_ip} | url: {url} | file: {out_path.name}\n")
+                            'format': 'photo',
+                            'timings': phase_times
+                        })
+                        event_log.emit('completed', job_id=download_id, phase='done', user=user_ip, url=url,
+                                       file=out_path.name, format='photo', method='pinterest_image_scrape',
+                                       bytes=out_path.stat().st_size, durations=phase_times)
                         return
                 raise Exception('Не найден URL изображения для данного ресурса')
         
     # Настройки yt-dlp
-        ydl_opts = {
-            'outtmpl': str(filepath.with_suffix('.%(ext)s')),
-            'quiet': True,
-            'no_warnings': True,
-            'progress_hooks': [lambda d: progress_hook(d, download_id)],
-            'nopart': True,  # Избегаем частичных файлов, чтобы предотвратить ошибку 416
-        }
-        # Try to locate ffmpeg and tell yt-dlp where it is (helps when ffmpeg isn't on PATH)
-        ffmpeg_path = find_ffmpeg()
-        if ffmpeg_path:
-            # yt-dlp accepts 'ffmpeg_location' pointing to ffmpeg binary or folder
-            # provide the parent folder so yt-dlp can find all helpers
-            ydl_opts['ffmpeg_location'] = str(Path(ffmpeg_path).parent)
-            logger.info(f"Using ffmpeg at: {ffmpeg_path}")
-        else:
-            logger.info("ffmpeg not found in PATH or local folder; merging formats may fail.")
-
-        if format_type == 'audio':
-            ydl_opts.update({
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            })
-            # audio_lang option removed — yt-dlp will pick default audio
-        else:
-            # Для YouTube: выбираем bestvideo+bestaudio с максимальным битрейтом и mp4
-            # Формат: bestvideo[ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best
-            # Для других сайтов fallback на старую схему
-            if 'youtube.com' in url or 'youtu.be' in url:
-                quality_map = {
-                    '1080': 'bestvideo[height<=1080][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
-                    '720': 'bestvideo[height<=720][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
-                    '480': 'bestvideo[height<=480][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
-                    '360': 'bestvideo[height<=360][ext=mp4][vcodec^=avc1]+bestaudio[ext=m4a]/best',
-                }
-                # If ffmpeg is missing, avoid requesting a merge of separate video+audio since that will fail.
-                if ffmpeg_path:
-                    ydl_opts.update({
-                        'format': quality_map.get(quality, 'bestvideo+bestaudio/best'),
-                        'merge_output_format': 'mp4',
-                    })
-                else:
-                    # Fallback: request the best single file (may already contain combined streams)
-                    logger.warning('ffmpeg not found — falling back to best single-file format to avoid merge error')
-                    ydl_opts.update({
-                        'format': 'best',
-                    })
-            else:
-                # Для TikTok и других сайтов, где может потребоваться перекодирование,
-                # используем postprocessor для гарантии mp4.
-                if 'tiktok.com' in url:
-                    ydl_opts.update({
-                        'format': 'bestvideo+bestaudio/best',
-                        'postprocessors': [{
-                            'key': 'FFmpegVideoConvertor',
-                            'preferedformat': 'mp4',
-                        }],
-                        'merge_output_format': 'mp4',
-                    })
-                    # Если ffmpeg нет, то слияние и конвертация не сработают, поэтому лучше выбрать лучший одиночный файл
-                    if not ffmpeg_path:
-                        logger.warning('ffmpeg not found — falling back to best single-file format for TikTok')
-                        ydl_opts.pop('postprocessors', None)
-                        ydl_opts['format'] = 'best'
-                else:
-                    quality_map = {
-                        '1080': 'best[height<=1080]/bestvideo[height<=1080]+bestaudio/best',
-                        '720': 'best[height<=720]/bestvideo[height<=720]+bestaudio/best',
-                        '480': 'best[height<=480]/bestvideo[height<=480]+bestaudio/best',
-                        '360': 'best[height<=360]/bestvideo[height<=360]+bestaudio/best',
-                    }
-                    if ffmpeg_path:
-                        ydl_opts.update({
-                            'format': quality_map.get(quality, 'best'),
-                            'merge_output_format': 'mp4',
-                        })
-                    else:
-                        logger.warning('ffmpeg not found — falling back to best single-file format to avoid merge error')
-                        ydl_opts.update({
-                            'format': 'best',
-                        })
-
-        # Special-case tweaks for Pinterest which sometimes lacks normal formats
-        try:
-            if 'pinterest.com' in url.lower() or 'pin.it' in url.lower():
-                # try settings that help with HLS / unusual containers
-                ydl_opts.update({
-                    'hls_prefer_native': True,
-                    'allow_unplayable_formats': True,
-                    # try prefer native best as initial attempt
-                    'format': ydl_opts.get('format', 'best')
-                })
-                logger.info('Applying Pinterest-friendly yt-dlp options')
-        except Exception:
-            pass
+        # streaming (opt-in on the page) reads the file under its final name, so only those jobs skip .part files
+        resumable = RESUMABLE_DOWNLOADS and not (stream and format_type == 'video' and STREAMING_ENABLED)
+        caps = get_ffmpeg_caps()
+        ffmpeg_path = caps.path if caps.can_merge_mp4 else None
+        ydl_opts, output_path = build_ydl_opts(url, format_type, quality, filepath, download_id, resumable, caps, info)
 
         # Helper: try to scrape a direct video URL from a Pinterest page and download it
         def try_pinterest_direct_download(page_url, out_path):
@@ -1310,32 +3536,45 @@ def download_media(url, format_type, quality, download_id, user_ip, check_downlo
                     # unescape if needed
                     video_url = video_url.replace('\\u0026', '&').replace('\\/', '/')
                     logger.info(f'Pinterest direct video URL found: {video_url}')
+                    # Resumable: continue a .part file left by an interrupted attempt via HTTP Range
+                    write_path = out_path.with_name(out_path.name + '.part') if resumable else out_path
+                    offset = write_path.stat().st_size if resumable and write_path.exists() else 0
+                    req_headers = dict(headers)
+                    if offset:
+                        req_headers['Range'] = f'bytes={offset}-'
                     # Stream download
-                    r2 = requests.get(video_url, headers=headers, stream=True, timeout=30)
-                    r2.raise_for_status()
-                    total = r2.headers.get('content-length')
-                    with open(out_path, 'wb') as fh:
-                        if total is None:
-                            fh.write(r2.content)
-                        else:
-                            dl = 0
-                            total_i = int(total)
-                            for chunk in r2.iter_content(chunk_size=8192):
-                                if chunk:
-                                    fh.write(chunk)
-                                    dl += len(chunk)
-                                    download_progress[download_id] = {'progress': (dl / total_i) * 100, 'status': 'downloading'}
-                    # write metadata
+                    r2 = requests.get(video_url, headers=req_headers, stream=True, timeout=30)
+                    if offset and r2.status_code == 416:
+                        # the part file already holds the whole video
+                        r2.close()
+                        os.replace(write_path, out_path)
+                    else:
+                        r2.raise_for_status()
+                        if r2.status_code != 206:
+                            offset = 0
+                        total = r2.headers.get('content-length')
+                        if stream:
+                            start_streaming(download_id, out_path)
+                        with open(write_path, 'ab' if offset else 'wb') as fh:
+                            if total is None:
+                                fh.write(r2.content)
+                            else:
+                                dl = offset
+                                total_i = int(total) + offset
+                                for chunk in r2.iter_content(chunk_size=8192):
+                                    if chunk:
+                                        fh.write(chunk)
+                                        dl += len(chunk)
+                                        METRIC_DOWNLOADED_BYTES.inc(len(chunk), site='pinterest')
+                                        report_transfer(download_id, dl, total_i)
+                        if write_path != out_path:
+                            os.replace(write_path, out_path)
+                    # register in catalog
                     try:
-                        metadata = {
-                            'url': page_url,
-                            'downloaded_at': datetime.datetime.now().isoformat(),
-                            'method': 'pinterest_direct'
-                        }
-                        with open(out_path.with_suffix(out_path.suffix + '.json'), 'w', encoding='utf-8') as mf:
-                            json.dump(metadata, mf, ensure_ascii=False, indent=2)
-                    except Exception:
-                        pass
+                        catalog.add(out_path.name, method='pinterest_direct',
+                                    size=out_path.stat().st_size, **catalog_fields)
+                    except Exception as e:
+                        logger.warning(f"Не удалось записать файл в каталог: {e}")
                     return True
                 return False
             except Exception as e:
@@ -1345,121 +3584,151 @@ def download_media(url, format_type, quality, download_id, user_ip, check_downlo
         # audio_lang handling removed (no per-request audio track selection)
 
         # Инициализация прогресса
-        download_progress[download_id] = {
+        set_progress(download_id, {
             'progress': 0,
             'status': 'downloading'
-        }
+        })
+        if stream and format_type == 'video' and STREAMING_ENABLED:
+            stream_candidates[download_id] = filepath
+        else:
+            stream = False
         
         # If this looks like a Pinterest URL and the user requested video, try direct scraping/download first
         try:
             if format_type == 'video' and ('pinterest.com' in url.lower() or 'pin.it' in url.lower()):
                 # use filepath as Path
                 out_path = filepath
-                success = try_pinterest_direct_download(url, out_path)
+                with timings.phase('transfer'):
+                    success = try_pinterest_direct_download(url, out_path)
+                METRIC_FALLBACKS.inc(path='pinterest_direct', result='success' if success else 'failure')
+                if success:
+                    METRIC_DOWNLOAD_SECONDS.observe(timings.get('transfer'), site=site)
                 if success and out_path.exists():
-                    download_progress[download_id] = {
+                    phase_times = timings.as_dict()
+                    catalog.set_timings(out_path.name, phase_times)
+                    set_progress(download_id, {
                         'progress': 100,
                         'status': 'completed',
                         'filename': out_path.name,
-                        'format': 'video'
-                    }
-                    with open(LOG_FILE, 'a', encoding='utf-8') as lf:
-                        lf.write(f"[{datetime.datetime.now().isoformat()}] PINTEREST DIRECT DOWNLOADED | user: {user_ip} | url: {url} | file: {out_path.name}\n")
+                        'format': 'video',
+                        'timings': phase_times
+                    })
+                    event_log.emit('completed', job_id=download_id, phase='done', user=user_ip, url=url,
+                                   file=out_path.name, format='video', method='pinterest_direct',
+                                   bytes=out_path.stat().st_size, durations=phase_times)
                     return
         except Exception:
             # ignore and continue to yt-dlp
             pass
 
-        # Загрузка with retry strategy for 'No video formats found' cases
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-        except Exception as e:
-            err = str(e)
-            # If yt-dlp couldn't find formats (common on some Pinterest pins), try a relaxed fallback
-            if 'no video formats found' in err.lower() or 'unable to extract' in err.lower():
-                logger.warning('Primary download failed with format error; retrying with relaxed options')
+        result = None
+        postprocess_wait = 0.0
+        postprocessors_ran = []
+        transfer_started = time.monotonic()
+        # Stream-while-downloading: separate video+audio are merged by ffmpeg on the fly into
+        # fragmented MP4, so /stream/<download_id> can serve playable bytes before the job ends
+        if stream and format_type == 'video' and ffmpeg_path and ydl_opts.get('merge_output_format') == 'mp4':
+            try:
+                formats = select_formats(ydl_opts, info)
+                if len(formats) > 1 and all(f.get('protocol') in ('http', 'https') for f in formats):
+                    # the player reads a separate live file, so the cached copy is never replaced under it
+                    live_path = filepath.with_name(filepath.name + '.live.part')
+                    merge_fragmented_mp4(download_id, formats, live_path, info.get('duration'), ffmpeg_path, ydl_opts)
+                    transfer_finished_at[download_id] = time.monotonic()
+                    # the cached copy must not be an empty_moov fragmented file: /file serves it for a year
+                    _, postprocess_wait = run_postprocess(download_id, faststart_mp4, live_path, filepath, ffmpeg_path)
+                    result = {'requested_downloads': [{'filepath': str(filepath)}]}
+                    postprocessors_ran = ['Merger']
+            except Exception as e:
+                if is_job_cancelled(download_id):
+                    raise
+                logger.warning(f"Потоковое слияние не удалось, обычная загрузка: {e}")
+                METRIC_FALLBACKS.inc(path='fragmented_mp4_merge', result='failure')
+                result = None
+                postprocess_wait = 0.0
+                transfer_finished_at.pop(download_id, None)
+                live_file = streaming_files.pop(download_id, None)
+                if live_file is not None:
+                    remove_live_file(live_file)
                 try:
-                    fallback_opts = dict(ydl_opts)
-                    fallback_opts.update({
-                        'format': 'best',
-                        'allow_unplayable_formats': True,
-                        'hls_prefer_native': True,
-                        'ignoreerrors': True,
-                    })
-                    with yt_dlp.YoutubeDL(fallback_opts) as ydl2:
-                        ydl2.download([url])
-                except Exception as e2:
-                    # rethrow original error if fallback failed
-                    raise Exception(f"Fallback download failed: {e2}")
-            else:
-                raise
+                    filepath.unlink()
+                except OSError:
+                    pass
 
-        # После успешной загрузки — найдём файл (по шаблону имени)
-        downloaded_file = None
-        # prefer exact filename
-        if filepath.exists():
-            downloaded_file = filepath
+        # Загрузка with retry strategy for 'No video formats found' cases
+        if result is None:
+            try:
+                with PooledYoutubeDL(ydl_opts, download_id=download_id) as ydl:
+                    result = download_with_info(ydl, info, url)
+                postprocess_wait = ydl.postprocess_wait
+                postprocessors_ran = ydl.postprocessors_ran
+            except Exception as e:
+                err = str(e)
+                # If yt-dlp couldn't find formats (common on some Pinterest pins), try a relaxed fallback
+                if 'no video formats found' in err.lower() or 'unable to extract' in err.lower():
+                    logger.warning('Primary download failed with format error; retrying with relaxed options')
+                    try:
+                        fallback_opts = dict(ydl_opts)
+                        fallback_opts.update({
+                            'format': 'best',
+                            'allow_unplayable_formats': True,
+                            'hls_prefer_native': True,
+                            'ignoreerrors': True,
+                        })
+                        with PooledYoutubeDL(fallback_opts, download_id=download_id) as ydl2:
+                            result = download_with_info(ydl2, info, url)
+                        postprocess_wait = ydl2.postprocess_wait
+                        postprocessors_ran = ydl2.postprocessors_ran
+                        METRIC_FALLBACKS.inc(path='relaxed_options', result='success')
+                    except Exception as e2:
+                        METRIC_FALLBACKS.inc(path='relaxed_options', result='failure')
+                        # rethrow original error if fallback failed
+                        raise Exception(f"Fallback download failed: {e2}")
+                else:
+                    raise
+
+        output_path = actual_output_path(format_type, output_path, postprocessors_ran)
+        METRIC_OUTPUT_PATH.inc(format=format_type, path=output_path or 'none')
+
+        # transfer ends at the last 'finished' hook; the rest until yt-dlp returns is postprocessing
+        transfer_done = time.monotonic()
+        finished_at = transfer_finished_at.pop(download_id, None)
+        if finished_at is not None and finished_at >= transfer_started:
+            timings.record('transfer', finished_at - transfer_started)
+            if postprocess_wait:
+                timings.record('postprocess_queue', postprocess_wait)
+            timings.record('postprocess', max(0.0, transfer_done - finished_at - postprocess_wait))
+            METRIC_POSTPROCESS_SECONDS.observe(timings.get('postprocess'), site=site, path=output_path or 'unknown')
         else:
-            for file in DOWNLOADS_DIR.glob(f"{filepath.stem}.*"):
-                if file.is_file():
-                    downloaded_file = file
-                    break
+            timings.record('transfer', transfer_done - transfer_started)
+        METRIC_DOWNLOAD_SECONDS.observe(timings.get('transfer'), site=site)
+
+        # После успешной загрузки — найдём файл (по результату yt-dlp)
+        with timings.phase('locate'):
+            downloaded_file = find_downloaded_file(result, filepath)
 
         if downloaded_file:
             final_filename = downloaded_file.name
-            # Write metadata file with info for future checks
-            metadata = {
-                'url': url,
-                'title': info.get('title') if info else None,
-                'uploader': info.get('uploader') if info else None,
-                'id': video_id,
-                'format': format_type,
-                'quality_requested': quality,
-                'downloaded_at': datetime.datetime.now().isoformat(),
-                'file_size': downloaded_file.stat().st_size
-            }
+            phase_times = timings.as_dict()
+            # Register the file in the catalog for future checks
             try:
-                with open(meta_file, 'w', encoding='utf-8') as mf:
-                    json.dump(metadata, mf, ensure_ascii=False, indent=2)
+                catalog.add(final_filename, method='yt-dlp', size=downloaded_file.stat().st_size,
+                            timings=json.dumps(phase_times), postprocess=output_path, **catalog_fields)
             except Exception as e:
-                logger.warning(f"Не удалось записать metadata JSON: {e}")
+                logger.warning(f"Не удалось записать файл в каталог: {e}")
 
-            download_progress[download_id] = {
+            set_progress(download_id, {
                 'progress': 100,
                 'status': 'completed',
                 'filename': final_filename,
-                'format': format_type
-            }
-            # Detailed logging
-            log_entry = (
-                f"[{datetime.datetime.now().isoformat()}] SUCCESS | user: {user_ip} | url: {url} | "
-                f"file: {final_filename} | size: {downloaded_file.stat().st_size} | format: {format_type} | quality: {quality}"
-            )
-            try:
-                with open(LOG_FILE, 'a', encoding='utf-8') as lf:
-                    lf.write(log_entry + '\n')
-            except Exception:
-                pass
-        else:
-            raise Exception("Файл не найден после загрузки")
-        
-        # Поиск скачанного файла
-        downloaded_file = None
-        for file in DOWNLOADS_DIR.glob(f"{filename.split('.')[0]}.*"):
-            if file.is_file():
-                downloaded_file = file
-                break
-        
-        if downloaded_file:
-            final_filename = downloaded_file.name
-            download_progress[download_id] = {
-                'progress': 100,
-                'status': 'completed',
-                'filename': final_filename,
-                'format': format_type
-            }
-            log_download(user_ip, url, final_filename, 'успешно')
+                'format': format_type,
+                'variant': catalog_fields['quality'] or None,
+                'timings': phase_times
+            })
+            event_log.emit('completed', job_id=download_id, phase='done', user=user_ip, url=url,
+                           file=final_filename, format=format_type, method='yt-dlp',
+                           quality=quality, bytes=downloaded_file.stat().st_size, durations=phase_times,
+                           message=f'postprocess: {output_path}' if output_path else None)
         else:
             raise Exception("Файл не найден после загрузки")
             
@@ -1476,12 +3745,183 @@ def download_media(url, format_type, quality, download_id, user_ip, check_downlo
             )
 
         logger.error(f"Ошибка загрузки: {error_msg}")
-        download_progress[download_id] = {
+        set_progress(download_id, {
             'progress': 0,
             'status': 'error',
-            'error': error_msg
-        }
-        log_download(user_ip, url, 'error', f'ошибка: {error_msg}')
+            'error': error_msg,
+            'timings': timings.as_dict()
+        })
+        event_log.emit('error', job_id=download_id, phase='error', user=user_ip, url=url, format=format_type,
+                       durations=timings.as_dict(), message=error_msg)
+
+class DownloadPool:
+    """Ограниченный пул рабочих потоков с FIFO-очередью заданий"""
+
+    def __init__(self, workers, max_queue, name='download', initializer=None):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.name = name
+        self.initializer = initializer
+        self.active = 0
+        self._pending = collections.deque()  # (job_id, func, args)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._released = set()
+        self._spawned = 0
+
+    def _spawn(self):
+        t = threading.Thread(target=self._worker, name=f'{self.name}-worker-{self._spawned}')
+        t.daemon = True
+        self._spawned += 1
+        self._threads.append(t)
+        t.start()
+
+    def _ensure_started(self):
+        # Threads are started lazily so importing the module (or the Flask reloader) doesn't spawn them
+        if self._threads:
+            return
+        for _ in range(self.workers):
+            self._spawn()
+
+    def release_slot(self):
+        """Отдаёт место текущего потока следующему заданию очереди (поток сам дорабатывает своё и завершается)"""
+        current = threading.current_thread()
+        with self._cond:
+            if current not in self._threads:
+                return False
+            self._threads.remove(current)
+            self._released.add(current)
+            self.active -= 1
+            self._spawn()
+            return True
+
+    def submit(self, job_id, func, *args):
+        """Ставит задание в очередь. Возвращает False, если очередь заполнена"""
+        with self._cond:
+            # jobs picked up right away by idle workers don't take queue places (max_queue=0: no waiting)
+            if len(self._pending) >= self.max_queue + max(0, self.workers - self.active):
+                return False
+            self._ensure_started()
+            self._pending.append((job_id, func, args))
+            self._cond.notify()
+            return True
+
+    def position(self, job_id):
+        """Позиция задания в очереди (1 — следующее), либо None если оно уже не ждёт"""
+        with self._cond:
+            for i, (pending_id, _, _) in enumerate(self._pending):
+                if pending_id == job_id:
+                    return i + 1
+        return None
+
+    def discard(self, job_id):
+        """Убирает ещё не начатое задание из очереди"""
+        with self._cond:
+            for item in self._pending:
+                if item[0] == job_id:
+                    self._pending.remove(item)
+                    return True
+        return False
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _worker(self):
+        if self.initializer is not None:
+            try:
+                self.initializer()
+            except Exception as e:
+                logger.warning(f"Не удалось настроить поток {threading.current_thread().name}: {e}")
+        current = threading.current_thread()
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job_id, func, args = self._pending.popleft()
+                self.active += 1
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Необработанная ошибка в задании {job_id}: {e}")
+            finally:
+                with self._cond:
+                    if current in self._released:
+                        # the slot was handed over to a replacement worker while this job waited
+                        self._released.discard(current)
+                        return
+                    self.active -= 1
+
+
+download_pool = DownloadPool(DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE)
+
+
+def parse_cpu_list(spec):
+    """'0-3,6' -> {0, 1, 2, 3, 6}"""
+    cpus = set()
+    for part in spec.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def _init_postprocess_worker():
+    # On Linux nice and affinity are per thread and inherited by the ffmpeg processes it starts
+    tid = threading.get_native_id()
+    if POSTPROCESS_NICE and hasattr(os, 'setpriority'):
+        os.setpriority(os.PRIO_PROCESS, tid, POSTPROCESS_NICE)
+    if POSTPROCESS_CPUS and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(tid, parse_cpu_list(POSTPROCESS_CPUS))
+
+postprocess_pool = DownloadPool(POSTPROCESS_WORKERS, POSTPROCESS_QUEUE_SIZE, name='postprocess',
+                                initializer=_init_postprocess_worker)
+
+
+def _jobs_by_status():
+    counts = collections.Counter(record.status for record in download_progress.records())
+    return {(status or 'unknown',): n for status, n in counts.items()}
+
+def _file_cache_hit_ratio():
+    hits = METRIC_FILE_CACHE.value(result='hit')
+    total = hits + METRIC_FILE_CACHE.value(result='miss')
+    return hits / total if total else 0
+
+metrics.register(Gauge('downloader_queue_depth', 'Jobs waiting for a download worker',
+                       collect=lambda: download_pool.queue_depth()))
+metrics.register(Gauge('downloader_active_workers', 'Download workers busy with a job',
+                       collect=lambda: download_pool.active))
+metrics.register(Gauge('downloader_postprocess_queue_depth', 'Jobs waiting for a postprocessing worker',
+                       collect=lambda: postprocess_pool.queue_depth()))
+metrics.register(Gauge('downloader_postprocess_active_workers', 'Postprocessing workers running ffmpeg',
+                       collect=lambda: postprocess_pool.active))
+metrics.register(Gauge('downloader_jobs', 'Jobs in memory by status', ('status',), collect=_jobs_by_status))
+metrics.register(Gauge('downloader_file_cache_hit_ratio', 'Share of jobs answered from an existing file',
+                       collect=_file_cache_hit_ratio))
+
+_serving_init_lock = threading.Lock()
+_serving_initialized = False
+
+def init_serving_process():
+    """Запуск в процессе, который обслуживает запросы: ffmpeg, очистка хранилища, задания из журнала (один раз)"""
+    global _serving_initialized
+    if _serving_initialized:
+        return
+    with _serving_init_lock:
+        if _serving_initialized:
+            return
+        _serving_initialized = True
+        DOWNLOADS_DIR.mkdir(exist_ok=True)
+        get_ffmpeg_caps()
+        try:
+            storage.maybe_evict()
+        except Exception as e:
+            logger.warning(f"Очистка хранилища при запуске не удалась: {e}")
+        restore_jobs()
+
+@app.before_request
+def _init_before_first_request():
+    init_serving_process()
 
 @app.route('/')
 def index():
@@ -1498,6 +3938,10 @@ def download():
         url = data.get('url')
         format_type = data.get('format', 'video')
         quality = data.get('quality', '720')
+        if format_type == 'audio':
+            # for audio "quality" selects the output: source codec as is, or MP3 on request
+            wants_mp3 = data.get('audio_format') == 'mp3' or AUDIO_OUTPUT_POLICY == 'mp3'
+            quality = 'mp3' if wants_mp3 else 'original'
         
         if not url:
             return jsonify({'success': False, 'error': 'URL не указан'})
@@ -1511,13 +3955,25 @@ def download():
         # Запуск загрузки в отдельном потоке (передаем опции)
         # extract per-request check flag (if sent)
         req_check = data.get('check_downloaded') if isinstance(data, dict) else None
+        req_stream = bool(data.get('stream')) if isinstance(data, dict) else False
+
+        # Identical request already running or queued: share its progress instead of downloading again
+        leader = attach_or_register(job_key(url, format_type, quality), download_id)
+        if leader is not None:
+            logger.info(f"Загрузка {download_id} присоединена к выполняющейся {leader}")
+            journal_event(download_id, 'attached', {'leader': leader})
+            return jsonify({
+                'success': True,
+                'download_id': download_id
+            })
 
-        thread = threading.Thread(
-            target=download_media,
-            args=(url, format_type, quality, download_id, user_ip, req_check)
-        )
-        thread.daemon = True
-        thread.start()
+        journal_event(download_id, 'submitted', {
+            'url': url, 'format': format_type, 'quality': quality, 'user_ip': user_ip,
+            'check_downloaded': req_check, 'stream': req_stream,
+        })
+        if not submit_job(download_id, url, format_type, quality, user_ip, req_check, req_stream):
+            journal_event(download_id, 'error', {'progress': 0, 'status': 'error', 'error': 'Очередь заполнена'})
+            return jsonify({'success': False, 'error': 'Сервер перегружен: очередь загрузок заполнена, попробуйте позже'}), 503
         
         return jsonify({
             'success': True,
@@ -1535,43 +3991,352 @@ def download():
 @app.route('/cancel/<download_id>', methods=['POST'])
 def cancel_download(download_id):
     """Устанавливает флаг отмены для загрузки"""
+    # only jobs this server knows about; arbitrary ids must not grow the flag table
+    if download_id not in download_progress and download_id not in download_aliases:
+        return ('', 404)
     download_cancelled[download_id] = True
-    # mark progress as cancelled
-    download_progress[download_id] = {
-        'progress': 0,
-        'status': 'error',
-        'error': 'Загрузка отменена пользователем'
-    }
+    journal_event(download_id, 'cancelled')
+    leader = resolve_download_id(download_id)
+    # The shared job keeps running while any other client still waits for it
+    if is_job_cancelled(leader):
+        # drop the job if it is still waiting in the queue
+        if download_pool.discard(leader):
+            release_inflight(leader)
+        # mark progress as cancelled
+        set_progress(leader, {
+            'progress': 0,
+            'status': 'error',
+            'error': 'Загрузка отменена пользователем'
+        })
+    else:
+        # only this client's view changed
+        notify_progress(download_id)
     return ('', 204)
 
+def progress_payload(download_id):
+    """Состояние загрузки в том виде, в котором его получает клиент"""
+    if download_cancelled.get(download_id):
+        return {'progress': 0, 'status': 'error', 'error': 'Загрузка отменена пользователем'}
+    download_id = resolve_download_id(download_id)
+    record = download_progress.get(download_id)
+    if record is None:
+        return {'progress': 0, 'status': 'waiting'}
+    data = record.to_dict()
+    if data.get('status') == 'queued':
+        data['position'] = download_pool.position(download_id)
+    elif data.get('status') == 'postprocessing':
+        data['position'] = postprocess_pool.position(download_id)
+    return data
+
+def _progress_version(download_id):
+    # a follower's view changes with its own cancel flag and with the leader's progress
+    leader = resolve_download_id(download_id)
+    version = progress_versions.get(download_id, 0)
+    if leader != download_id:
+        version += progress_versions.get(leader, 0)
+    return version
+
 @app.route('/progress/<download_id>')
 def get_progress(download_id):
     """Получение прогресса загрузки"""
-    if download_id in download_progress:
-        return jsonify(download_progress[download_id])
+    return jsonify(progress_payload(download_id))
+
+@app.route('/progress/<download_id>/stream')
+def stream_progress(download_id):
+    """Server-Sent Events: прогресс отправляется только при изменении"""
+    def generate():
+        # the browser reconnects by itself after this delay; the first event is always the full state
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        last_payload = None
+        last_sent = time.monotonic()
+        while True:
+            with progress_lock:
+                version = _progress_version(download_id)
+            data = progress_payload(download_id)
+            payload = json.dumps(data, ensure_ascii=False)
+            now = time.monotonic()
+            if payload != last_payload:
+                yield f"id: {version}\ndata: {payload}\n\n"
+                last_payload = payload
+                last_sent = now
+                if data.get('status') in ('completed', 'error'):
+                    return
+            elif now - last_sent >= SSE_HEARTBEAT_SECONDS:
+                yield ": ping\n\n"
+                last_sent = now
+            # queue positions move without an event for this job, so re-check those every second
+            timeout = 1.0 if data.get('status') in ('queued', 'waiting', 'postprocessing') else SSE_HEARTBEAT_SECONDS
+            wait_for_progress(download_id, version, timeout)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # nginx: don't buffer the stream
+    })
+
+def _tail_growing_file(path, download_id):
+    """Отдаёт файл по мере записи, пока загрузка не завершится"""
+    try:
+        yield from _read_growing_file(path, download_id)
+    finally:
+        # a live merge file is only for players: once the job let go of it, the last reader removes it
+        if path.name.endswith('.live.part') and streaming_files.get(download_id) != path:
+            remove_live_file(path)
+
+def _read_growing_file(path, download_id):
+    f = None
+    while f is None:
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            record = download_progress.get(download_id)
+            if record is None or record.status in ('completed', 'error'):
+                return
+            time.sleep(0.2)
+    with f:
+        while True:
+            with progress_lock:
+                version = _progress_version(download_id)
+            chunk = f.read(FILE_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+            record = download_progress.get(download_id)
+            if record is None or record.status == 'error':
+                return
+            if record.status == 'completed' or download_id not in streaming_files:
+                # writer is done: drain what is left and stop
+                while True:
+                    chunk = f.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+            wait_for_progress(download_id, version, 0.5)
+
+@app.route('/stream/<download_id>')
+def stream_file(download_id):
+    """Отдача файла во время загрузки"""
+    if download_cancelled.get(download_id):
+        return "Загрузка отменена", 404
+    download_id = resolve_download_id(download_id)
+    path = streaming_files.get(download_id)
+    if path is None:
+        record = download_progress.get(download_id)
+        if record is not None and record.status == 'completed' and record.filename:
+            # already finished: the regular endpoint supports Range and caching
+            return redirect(f'/file/{quote(record.filename)}')
+        return "Поток недоступен", 404
+    guessed, _ = mimetypes.guess_type(str(path))
+    return Response(_tail_growing_file(path, download_id), mimetype=guessed or 'video/mp4', headers={
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/stats')
+def get_stats():
+    """Внутренняя статистика сервера (кэши, очередь)"""
+    return jsonify({
+        'metadata_cache': metadata_cache.stats(),
+        'storage': storage.stats(),
+        'event_log': event_log.stats(),
+        'jobs': download_progress.stats(),
+        'download_pool': {
+            'workers': download_pool.workers,
+            'active': download_pool.active,
+            'queued': download_pool.queue_depth(),
+        },
+        'postprocess_pool': {
+            'workers': postprocess_pool.workers,
+            'active': postprocess_pool.active,
+            'queued': postprocess_pool.queue_depth(),
+        },
+    })
+
+@app.route('/diagnostics')
+def get_diagnostics():
+    """Окружение сервера: ffmpeg и его возможности, версии, основные настройки"""
+    return jsonify({
+        'ffmpeg': get_ffmpeg_caps().to_dict(),
+        'yt_dlp': yt_dlp.version.__version__,
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'config': {
+            'download_workers': DOWNLOAD_WORKERS,
+            'download_queue_size': DOWNLOAD_QUEUE_SIZE,
+            'postprocess_workers': POSTPROCESS_WORKERS,
+            'postprocess_nice': POSTPROCESS_NICE,
+            'postprocess_cpus': POSTPROCESS_CPUS or None,
+            'streaming_enabled': STREAMING_ENABLED,
+            'resumable_downloads': RESUMABLE_DOWNLOADS,
+            'file_offload': FILE_OFFLOAD or None,
+            'storage_budget_bytes': STORAGE_BUDGET_BYTES,
+            'video_cache_policy': VIDEO_CACHE_POLICY,
+        },
+    })
+
+@app.route('/metrics')
+def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def _iter_file(f, length):
+    """Читает length байт с текущей позиции файла и закрывает его"""
+    try:
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def _file_body(filepath, start, length, size):
+    """Тело ответа для куска файла — через wsgi.file_wrapper (sendfile), где сервер это позволяет"""
+    f = open(filepath, 'rb')
+    if start:
+        f.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    server = request.environ.get('SERVER_SOFTWARE', '').lower()
+    if file_wrapper is not None and (length == size or server.startswith(RANGE_FILE_WRAPPER_SERVERS)):
+        return file_wrapper(f, FILE_CHUNK_SIZE)
+    return _iter_file(f, length)
+
+def _iter_multipart(filepath, parts, boundary, mimetype, size):
+    for start, stop in parts:
+        yield (f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+               f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode('ascii')
+        f = open(filepath, 'rb')
+        f.seek(start)
+        yield from _iter_file(f, stop - start)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode('ascii')
+
+def _content_disposition(download_name):
+    try:
+        download_name.encode('ascii')
+        return {'filename': download_name}
+    except UnicodeEncodeError:
+        # titles are often Cyrillic: ASCII fallback plus RFC 5987 filename*
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple or 'media', 'filename*': "UTF-8''" + quote(download_name, safe='')}
+
+def send_media_file(filepath, mimetype, as_attachment=False, download_name=None):
+    """Отдаёт файл с сильным ETag, условными запросами (304) и Range (206, в т.ч. multipart)"""
+    st = filepath.stat()
+    size = st.st_size
+    etag = f"{size:x}-{st.st_mtime_ns:x}"
+    last_modified = datetime.datetime.fromtimestamp(int(st.st_mtime), datetime.timezone.utc)
+
+    def finish(response):
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.cache_control.public = True
+        response.cache_control.max_age = FILE_CACHE_MAX_AGE
+        response.cache_control.immutable = True
+        if as_attachment:
+            response.headers.set('Content-Disposition', 'attachment', **_content_disposition(download_name or filepath.name))
+        return response
+
+    if request.method in ('GET', 'HEAD') and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return finish(Response(status=304))
+
+    parts = None
+    if request.range is not None and request.range.units == 'bytes':
+        # If-Range: the client's copy is stale, so the range no longer applies — send everything
+        if_range = request.if_range
+        if if_range.etag:
+            range_valid = if_range.etag == etag
+        elif if_range.date:
+            range_valid = last_modified <= if_range.date
+        else:
+            range_valid = True
+        if range_valid and len(request.range.ranges) <= MAX_RANGES_PER_REQUEST:
+            parts = []
+            for start, stop in request.range.ranges:
+                if start < 0:
+                    start, stop = max(size + start, 0), size
+                else:
+                    stop = size if stop is None else min(stop, size)
+                if start < stop:
+                    parts.append((start, stop))
+            if not parts:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f"bytes */{size}"
+                return finish(response)
+
+    if not parts:
+        response = Response(_file_body(filepath, 0, size, size), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = size
+    elif len(parts) == 1:
+        start, stop = parts[0]
+        response = Response(_file_body(filepath, start, stop - start, size), status=206,
+                            mimetype=mimetype, direct_passthrough=True)
+        response.content_length = stop - start
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        boundary = uuid.uuid4().hex
+        body_length = len(f"--{boundary}--\r\n")
+        for start, stop in parts:
+            body_length += len(f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                               f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n") + (stop - start) + 2
+        response = Response(_iter_multipart(filepath, parts, boundary, mimetype, size), status=206,
+                            direct_passthrough=True)
+        response.headers['Content-Type'] = f"multipart/byteranges; boundary={boundary}"
+        response.content_length = body_length
+    return finish(response)
+
+def offload_media_file(filepath, mimetype, as_attachment=False, download_name=None):
+    """Ответ без тела: файл отдаёт прокси по X-Accel-Redirect / X-Sendfile"""
+    response = Response(mimetype=mimetype)
+    if FILE_OFFLOAD == 'x-sendfile':
+        # header values must stay latin-1, titles are not: percent-encode the path (mod_xsendfile decodes it)
+        response.headers['X-Sendfile'] = quote(str(filepath), safe='/:\\')
     else:
-        return jsonify({'progress': 0, 'status': 'waiting'})
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(filepath.name)
+    # the proxy handles Range / ETag / Last-Modified itself for the static file
+    response.cache_control.public = True
+    response.cache_control.max_age = FILE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    if as_attachment:
+        response.headers.set('Content-Disposition', 'attachment', **_content_disposition(download_name or filepath.name))
+    return response
 
 @app.route('/file/<filename>')
 def serve_file(filename):
     """Отдача файла для просмотра или скачивания"""
     try:
-        filepath = DOWNLOADS_DIR / filename
+        # Only files known to the catalog are served (also keeps log.jsonl / catalog DB private)
+        entry = catalog.get(filename)
+        if not entry:
+            METRIC_SERVED_REQUESTS.inc(code=404)
+            return "Файл не найден", 404
+        filepath = DOWNLOADS_DIR / entry['filename']
         if not filepath.exists():
+            catalog.remove(entry['filename'])
+            METRIC_SERVED_REQUESTS.inc(code=404)
             return "Файл не найден", 404
         
+ 
+        # Определяем тип через mimetypes
+        guessed, _ = mimetypes.guess_type(str(filepath))
+        mimetype = guessed or ('video/mp4' if filename.endswith('.mp4') else 'application/octet-stream')
         # Проверка, нужно ли форсировать скачивание
-        if request.args.get('download') == 'true':
-            return send_file(
-                filepath,
-                as_attachment=True,
-                download_name=filename
-            )
+        as_attachment = request.args.get('download') == 'true'
+        # LRU eviction works off last_access; players fire many Range requests, so write it sparingly
+        storage.mark_served(entry['filename'])
+        now = time.time()
+        if now - (entry['last_access'] or 0) >= STORAGE_TOUCH_INTERVAL:
+            catalog.touch(entry['filename'], now)
+        if FILE_OFFLOAD in ('x-accel', 'x-sendfile'):
+            response = offload_media_file(filepath.resolve(), mimetype, as_attachment=as_attachment, download_name=filename)
         else:
-            # Для просмотра в браузере: определяем тип через mimetypes
-            guessed, _ = mimetypes.guess_type(str(filepath))
-            mimetype = guessed or ('video/mp4' if filename.endswith('.mp4') else 'application/octet-stream')
-            return send_file(filepath, mimetype=mimetype)
+            response = send_media_file(filepath.resolve(), mimetype, as_attachment=as_attachment, download_name=filename)
+            if response.content_length and request.method == 'GET':
+                METRIC_SERVED_BYTES.inc(response.content_length)
+        METRIC_SERVED_REQUESTS.inc(code=response.status_code)
+        return response
             
     except Exception as e:
         logger.error(f"Ошибка отдачи файла: {e}")
@@ -1590,6 +4355,11 @@ def server_error(e):
 if __name__ == '__main__':
     # Создание папки для загрузок если её нет
     DOWNLOADS_DIR.mkdir(exist_ok=True)
+
+    # With the debug reloader the watching parent never serves requests; start right away in the
+    # serving child, every other setup (gunicorn, waitress, debug=False) starts on the first request
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_serving_process()
     
     print("""
     ╔════════════════════════════════════════════╗